@@ -0,0 +1,279 @@
+"""Compare loading and scoring reviews stored as text dates and as epochs.
+
+The old path is the one before the epoch migration: a Review per row with
+its reference fetched and its date parsed by pendulum, scored with pendulum
+durations. Both run over the same reviews.
+
+Run from the repository root:
+
+    python benchmarks/epoch.py --reviews 50000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from typing import FrozenSet
+
+import attr
+import peewee
+import pendulum
+from pendulum import Duration
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from memorize.model import (Reference, ReviewPrompAspect,  # noqa: E402
+                            ReviewResponseAspect, ReviewResult)
+
+PROMPTS = ["reference,blind", "reference,first-word",
+           "reference,first-letters", "full-text,reference"]
+RESULTS = ["easy", "easy", "easy", "hard", "fail"]
+
+
+def make_legacy_db(path, references, count):
+    """Write a reviews.db using the old text `date` schema."""
+    con = sqlite3.connect(path)
+    con.execute("CREATE TABLE referencemodel (id INTEGER NOT NULL PRIMARY KEY,"
+                " book VARCHAR(255) NOT NULL, chapter INTEGER NOT NULL,"
+                " verse INTEGER NOT NULL, verse_end INTEGER NOT NULL)")
+    con.execute("CREATE TABLE reviewmodel (id INTEGER NOT NULL PRIMARY KEY,"
+                " reference_id INTEGER NOT NULL, date DATETIME NOT NULL,"
+                " prompt VARCHAR(255) NOT NULL,"
+                " response VARCHAR(255) NOT NULL,"
+                " result VARCHAR(255) NOT NULL)")
+    con.executemany("INSERT INTO referencemodel VALUES (?, 'Gen', ?, ?, ?)",
+                    [(i + 1, c, v, v) for i, (c, v) in enumerate(references)])
+    rnd = random.Random(1)
+    start = pendulum.datetime(2020, 1, 1, tz="America/New_York")
+    con.executemany(
+        "INSERT INTO reviewmodel (reference_id, date, prompt, response,"
+        " result) VALUES (?, ?, ?, 'read-aloud', ?)",
+        [(rnd.randrange(len(references)) + 1,
+          start.add(seconds=n * 600).isoformat(),
+          rnd.choice(PROMPTS), rnd.choice(RESULTS))
+         for n in range(count)])
+    con.commit()
+    return con
+
+
+# The models, Review and ReviewScore as they were before the migration
+
+legacy_db = peewee.SqliteDatabase(None)
+
+
+@attr.frozen(order=True)
+class LegacyReview:
+    reference: Reference
+    date: pendulum.DateTime
+    prompt: FrozenSet[ReviewPrompAspect]
+    response: FrozenSet[ReviewResponseAspect]
+    result: ReviewResult
+
+
+class LegacyReferenceModel(peewee.Model):
+    book = peewee.CharField()
+    chapter = peewee.IntegerField()
+    verse = peewee.IntegerField()
+    verse_end = peewee.IntegerField()
+
+    class Meta:
+        database = legacy_db
+        table_name = "referencemodel"
+
+    def to_reference(self):
+        return Reference(self.book, self.chapter, self.verse, self.verse_end)
+
+
+class LegacyReviewModel(peewee.Model):
+    reference = peewee.ForeignKeyField(LegacyReferenceModel,
+                                       backref="reviews")
+    # Text, the peewee of the time didn't parse ISO 8601 with an offset
+    date = peewee.CharField()
+    prompt = peewee.CharField()
+    response = peewee.CharField()
+    result = peewee.CharField()
+
+    class Meta:
+        database = legacy_db
+        table_name = "reviewmodel"
+
+    def to_review(self):
+        return LegacyReview(self.reference.to_reference(),
+                            pendulum.parse(self.date),
+                            frozenset(ReviewPrompAspect(s)
+                                      for s in self.prompt.split(",")),
+                            frozenset(ReviewResponseAspect(s)
+                                      for s in self.response.split(",")),
+                            ReviewResult(self.result))
+
+
+class LegacyReviewScore:
+    def __init__(self, reference, reviews):
+        self.reference = reference
+        self.score = 1
+        self.review_bucket = 0
+        self.due = pendulum.now() - Duration(seconds=1)
+        self.frequency = Duration(hours=0)
+        self.last_easy = None
+        self.last_hard_or_failed = None
+        self.fails_in_a_row = 0
+        self.previous_easy = None
+        self.purgatory_countdown = 0
+        self.prompt = None
+        reviews.sort(key=lambda r: r.date)
+        prev = None
+        for r in reviews:
+            self.feed(r, prev)
+            prev = r
+        self.finalize(reviews)
+
+    def feed(self, review, previous_review):
+        if review.result == ReviewResult.FAIL:
+            self.fails_in_a_row += 1
+            if self.purgatory_countdown:
+                self.purgatory_countdown = 5
+            elif self.fails_in_a_row == 2:
+                self.purgatory_countdown = 5
+        else:
+            self.fails_in_a_row = 0
+        if review.result == ReviewResult.EASY:
+            if self.purgatory_countdown:
+                self.purgatory_countdown -= 1
+        if self.purgatory_countdown:
+            self.prompt = {ReviewPrompAspect.REFERENCE,
+                           ReviewPrompAspect.FIRST_LETTERS}
+            self.frequency = Duration(hours=6)
+        else:
+            self.prompt = review.prompt
+
+        if self.frequency < Duration(hours=6):
+            self.frequency = Duration(hours=6)
+        if review.result == ReviewResult.FAIL:
+            self.last_hard_or_failed = review
+            self.frequency -= Duration(hours=6)
+            if self.frequency > Duration(days=1):
+                self.frequency *= .3
+        elif review.result == ReviewResult.HARD:
+            self.last_hard_or_failed = review
+            self.frequency -= Duration(hours=4)
+            if self.frequency > Duration(days=1):
+                self.frequency *= .7
+        elif review.result == ReviewResult.EASY:
+            self.last_easy = review
+            if (self.previous_easy and (review.date - self.previous_easy.date)
+                    < Duration(hours=4)):
+                self.previous_easy = review
+                return
+            self.previous_easy = review
+            if ReviewPrompAspect.BLIND in review.prompt:
+                self.frequency += Duration(hours=24)
+                if (previous_review
+                        and previous_review.result == ReviewResult.EASY):
+                    a = pendulum.instance(previous_review.date)
+                    b = pendulum.instance(review.date)
+                    d = b.diff(a) * 1.32
+                    if d > self.frequency:
+                        self.frequency = d
+            elif ReviewPrompAspect.FIRST_WORD in review.prompt:
+                self.frequency += Duration(hours=12)
+            elif ReviewPrompAspect.FIRST_LETTERS in review.prompt:
+                self.frequency = Duration(hours=6)
+            elif ReviewPrompAspect.ENDING_UNDERSCORE in review.prompt:
+                self.frequency = Duration(hours=6)
+
+    def finalize(self, reviews):
+        self.review_bucket = 5
+        if self.frequency < Duration(days=3):
+            self.review_bucket = 2
+        elif self.frequency < Duration(weeks=1):
+            self.review_bucket = 3
+        elif self.frequency < Duration(weeks=3):
+            self.review_bucket = 4
+        if self.last_easy:
+            self.due_date = self.last_easy.date + self.frequency
+        else:
+            self.score = 1
+            self.review_bucket = 1
+            self.due_date = pendulum.now() - Duration(seconds=1)
+            return
+        if self.last_hard_or_failed:
+            min_due_date = self.last_hard_or_failed.date + Duration(hours=2)
+            if min_due_date > self.due_date:
+                self.due_date = min_due_date
+            if (self.last_easy
+                    and self.last_easy.date < self.last_hard_or_failed.date):
+                self.review_bucket = 1
+        now = pendulum.now()
+        if self.last_easy:
+            self.ratio = (now - self.last_easy.date) / \
+                (self.due_date - self.last_easy.date)
+        else:
+            self.review_bucket = 0
+            self.ratio = 0
+        if now > self.due_date:
+            self.score = 10 + (now - self.due_date).days
+        else:
+            self.score = 0
+
+
+def legacy_load(path):
+    legacy_db.init(path)
+    with legacy_db:
+        return [m.to_review() for m in LegacyReviewModel.select()]
+
+
+def by_reference(reviews):
+    grouped = {}
+    for r in reviews:
+        grouped.setdefault(r.reference, []).append(r)
+    return list(grouped.items())
+
+
+def timed(f):
+    start = time.perf_counter()
+    res = f()
+    return time.perf_counter() - start, res
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--reviews", type=int, default=50000)
+    parser.add_argument("--chapters", type=int, default=50)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    references = [(c, v) for c in range(1, args.chapters + 1)
+                  for v in range(1, 21)]
+    with open("verses.yaml", "w") as f:
+        for c, v in references:
+            f.write(f'"Gen {c}:{v}": "In the beginning God created"\n')
+    make_legacy_db("reviews.db", references, args.reviews).close()
+
+    old_load, old_reviews = timed(lambda: legacy_load("reviews.db"))
+    old_grouped = by_reference(old_reviews)
+    old_score, _ = timed(lambda: [LegacyReviewScore(ref, rs)
+                                  for ref, rs in old_grouped])
+
+    def migrate():
+        from memorize import reviews
+        reviews.setup_local_database()
+        return reviews
+    migration, reviews = timed(migrate)
+    new_load, new_reviews = timed(lambda: list(reviews.load_sqlite()))
+    new_grouped = by_reference(new_reviews)
+
+    from memorize.schedule import ReviewScore
+    new_score, _ = timed(lambda: [ReviewScore(ref, rs)
+                                  for ref, rs in new_grouped])
+
+    print(f"{len(old_reviews)} reviews of {len(old_grouped)} verses, "
+          f"migrated in {migration:.3f}s")
+    print(f"{'':8} {'old':>9} {'new':>9}")
+    for label, old, new in [("load", old_load, new_load),
+                            ("score", old_score, new_score)]:
+        print(f"{label:8} {old:8.3f}s {new:8.3f}s  {old / new:6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""Run concurrent learners against memorize.server and report latencies.
+
+Each session picks its candidates, renders each prompt, grades a slightly
+wrong recitation and saves the review, pausing --think seconds between
+requests like someone reciting would.
+
+    python benchmarks/load_server.py --sessions 40 --seconds 30
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from suite import WORDS, write_verses  # noqa: E402
+
+
+class Client:
+
+    def __init__(self, reader, writer, user, latencies):
+        self.reader = reader
+        self.writer = writer
+        self.user = user
+        self.latencies = latencies
+        self.next_id = 0
+
+    async def call(self, method, **params):
+        self.next_id += 1
+        request = {"id": self.next_id, "user": self.user, "method": method,
+                   "params": params}
+        start = time.perf_counter()
+        self.writer.write(json.dumps(request).encode() + b"\n")
+        await self.writer.drain()
+        response = json.loads(await self.reader.readline())
+        self.latencies.append((start, method, time.perf_counter() - start))
+        if "error" in response:
+            raise RuntimeError(f"{method}: {response['error']}")
+        return response["result"]
+
+
+async def session(port, user, verses, end, think, latencies, seed):
+    rnd = random.Random(seed)
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    client = Client(reader, writer, user, latencies)
+    reviews = 0
+    while time.perf_counter() < end:
+        for candidate in await client.call("candidates", count=5):
+            reference = candidate["reference"]
+            prompt = candidate["prompt"]
+            while prompt and time.perf_counter() < end:
+                await client.call("prompt", reference=reference,
+                                  prompt=prompt)
+                await asyncio.sleep(think)
+                words = verses[reference].split()
+                for _ in range(rnd.randrange(3)):
+                    words[rnd.randrange(len(words))] = rnd.choice(WORDS)
+                text = " ".join(words)
+                graded = await client.call("grade", reference=reference,
+                                           text=text)
+                saved = await client.call(
+                    "review", reference=reference, prompt=prompt,
+                    result=graded["result"], text=text,
+                    score=graded["score"])
+                reviews += 1
+                prompt = saved["next_prompt"]
+                await asyncio.sleep(think)
+    writer.close()
+    return reviews
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def report(latencies, start, seconds, window):
+    by_method = {}
+    for _, method, latency in latencies:
+        by_method.setdefault(method, []).append(latency)
+    summary = {"methods": {}, "windows": []}
+    for method, values in sorted(by_method.items()):
+        summary["methods"][method] = {
+            "count": len(values),
+            "p50_ms": _percentile(values, .5) * 1000,
+            "p95_ms": _percentile(values, .95) * 1000,
+            "p99_ms": _percentile(values, .99) * 1000,
+            "max_ms": max(values) * 1000,
+        }
+    for w in range(0, int(seconds), window):
+        values = [latency for t, _, latency in latencies
+                  if w <= t - start < w + window]
+        if values:
+            summary["windows"].append({
+                "start_s": w, "requests": len(values),
+                "p50_ms": _percentile(values, .5) * 1000,
+                "p95_ms": _percentile(values, .95) * 1000,
+            })
+    return summary
+
+
+async def run(port, verses, sessions, seconds, think):
+    latencies = []
+    start = time.perf_counter()
+    end = start + seconds
+    reviews = await asyncio.gather(*(
+        session(port, f"learner{i}", verses, end, think, latencies, i)
+        for i in range(sessions)))
+    return latencies, start, sum(reviews)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for(port, server, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if server.poll() is not None:
+            sys.exit(f"server exited with {server.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            time.sleep(.1)
+    sys.exit("server didn't start")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=40)
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument("--think", type=float, default=.2,
+                        help="seconds between a session's requests")
+    parser.add_argument("--verses", type=int, default=2000)
+    parser.add_argument("--window", type=int, default=5,
+                        help="seconds per latency window")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="memorize-server-")
+    path = os.path.join(directory, "verses.yaml")
+    write_verses(path, args.verses, random.Random(1))
+    with open(path) as f:
+        verses = yaml.safe_load(f)
+
+    port = _free_port()
+    env = dict(os.environ,
+               PYTHONPATH=os.pathsep.join(
+                   filter(None, [ROOT, os.environ.get("PYTHONPATH")])))
+    server = subprocess.Popen(
+        [sys.executable, "-m", "memorize.server", "--port", str(port)],
+        cwd=directory, env=env, stdout=subprocess.DEVNULL)
+    try:
+        _wait_for(port, server)
+        latencies, start, reviews = asyncio.run(
+            run(port, verses, args.sessions, args.seconds, args.think))
+    finally:
+        server.terminate()
+        server.wait()
+
+    summary = report(latencies, start, args.seconds, args.window)
+    summary["sessions"] = args.sessions
+    summary["reviews"] = reviews
+    summary["requests_per_second"] = len(latencies) / args.seconds
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+    print(f"{args.sessions} sessions, {reviews} reviews, "
+          f"{summary['requests_per_second']:.0f} requests/s")
+    for method, s in summary["methods"].items():
+        print(f"  {method:10} n={s['count']:6} p50 {s['p50_ms']:7.2f} ms  "
+              f"p95 {s['p95_ms']:7.2f} ms  p99 {s['p99_ms']:7.2f} ms  "
+              f"max {s['max_ms']:7.2f} ms")
+    print("  p95 by window:", " ".join(
+        f"{w['p95_ms']:.1f}" for w in summary["windows"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Hammer reviews.db from several processes at once.
+
+Writers save reviews while readers stream and count them, both through the
+regular connection and the read-only one. Fails if any process hits an
+error or a review goes missing.
+
+    python benchmarks/stress_db.py --writers 4 --readers 4 --reviews 200
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _import_reviews(directory):
+    sys.path.insert(0, ROOT)
+    os.chdir(directory)
+    from memorize import reviews
+    return reviews
+
+
+def writer(directory, index, count):
+    reviews = _import_reviews(directory)
+    reference = reviews.Reference("Gen", 1, 1 + index % 3, 1 + index % 3)
+    prompt = frozenset({reviews.ReviewPrompAspect.BLIND})
+    response = frozenset({reviews.ReviewResponseAspect.READ_ALOUD})
+    for i in range(count):
+        r = reviews.Review(reference, 1600000000 + index * 1000000 + i,
+                           prompt, response, reviews.ReviewResult.EASY)
+        reviews.save_review(r)
+
+
+def reader(directory, seconds):
+    reviews = _import_reviews(directory)
+    end = time.time() + seconds
+    passes = 0
+    while time.time() < end:
+        for _, group in reviews.iter_reviews_by_reference():
+            for _ in group:
+                pass
+        with reviews.connection(read_only=True) as database:
+            database.execute(reviews.ReviewModel.select()).fetchall()
+        passes += 1
+    return passes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--reviews", type=int, default=200,
+                        help="reviews saved by each writer")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    with open(os.path.join(directory, "verses.yaml"), "w") as f:
+        for v in range(1, 4):
+            f.write(f'"Gen 1:{v}": "In the beginning God created"\n')
+    # Create the database before the workers start using it.
+    reviews = _import_reviews(directory)
+    reviews.setup_local_database()
+
+    start = time.perf_counter()
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(args.writers + args.readers) as pool:
+        writes = [pool.apply_async(writer, (directory, i, args.reviews))
+                  for i in range(args.writers)]
+        reads = [pool.apply_async(reader, (directory, 2))
+                 for _ in range(args.readers)]
+        for w in writes:
+            w.get()
+        passes = sum(r.get() for r in reads)
+    elapsed = time.perf_counter() - start
+
+    stored = reviews.ReviewModel.select().count()
+    expected = args.writers * args.reviews
+    print(f"{expected} writes and {passes} read passes in {elapsed:.2f}s, "
+          f"{stored} reviews stored")
+    if stored != expected:
+        sys.exit(f"lost {expected - stored} reviews")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+"""Time the core pipeline on synthetic decks of increasing size.
+
+Each deck is generated in a temporary directory and measured in a fresh
+process, since memorize loads verses.yaml on import.
+
+    python benchmarks/suite.py --output baseline.json
+    python benchmarks/suite.py --decks small,medium --compare baseline.json
+
+Every result is seconds per operation, so lower is better. Comparing
+exits with status 1 if any result is slower than the baseline by more
+than --threshold.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name: (verses, reviews)
+DECKS = {
+    "tiny": (100, 1000),
+    "small": (1000, 10000),
+    "medium": (5000, 100000),
+    "large": (30000, 1000000),
+}
+
+BOOKS = ["Gen", "Exod", "Lev", "Num", "Deut", "Josh", "Judg", "Ruth",
+         "Matt", "Mark", "Luke", "John", "Acts", "Rom", "Gal", "Eph"]
+WORDS = """and the of to that in he shall unto for i his a lord they be is
+him not them it with all thou thy was god which my me said but ye their
+have unto were people son children heaven earth light darkness spirit
+grace truth love world life death sin righteousness faith believe father
+word mercy peace glory king house come go went out made day night before
+water land man men come great give hand hear know let one may upon when
+who what from this there then so by also even now said because eternal
+kingdom holy called brought walk way behold servant law commandment
+blessed hope fear wisdom understanding heart soul strength""".split()
+RESULTS = ["easy"] * 6 + ["hard"] * 2 + ["fail"] * 2
+# Imports are timed in this many fresh processes, keeping the fastest.
+IMPORT_SAMPLES = 5
+
+
+def _sentence(rnd, length):
+    words = [rnd.choice(WORDS) for _ in range(length)]
+    words[0] = words[0].capitalize()
+    for i in range(4, length - 1, rnd.randint(5, 9)):
+        words[i] += rnd.choice([",", ";", ":"])
+    return " ".join(words) + "."
+
+
+def write_verses(path, count, rnd):
+    references = []
+    book = chapter = 0
+    verse = 30
+    while len(references) < count:
+        if verse == 30:
+            verse = 0
+            chapter += 1
+            if chapter > 50:
+                chapter = 1
+                book += 1
+        verse += 1
+        # Numbered books once the names run out, Gen2, Exod2...
+        name = BOOKS[book % len(BOOKS)] + str(book // len(BOOKS) or "")
+        references.append(f"{name} {chapter}:{verse}")
+    with open(path, "w") as f:
+        for reference in references:
+            text = _sentence(rnd, rnd.randint(10, 40))
+            f.write(f'"{reference}": "{text}"\n')
+
+
+def generate(count):
+    """Fill reviews.db in the current directory, run in the deck process."""
+    from memorize import reviews
+    from memorize.model import Review, text_prompt_levels
+    reviews.setup_local_database()
+    rnd = random.Random(2)
+    references = list(reviews.verses)
+    model = reviews.ReferenceModel
+    with reviews.db.atomic():
+        model.insert_many(
+            [(r.book, r.chapter, r.verse, r.verse_end) for r in references],
+            fields=[model.book, model.chapter, model.verse,
+                    model.verse_end]).execute()
+    ids = {m.to_reference(): m.id for m in reviews.ReferenceModel.select()}
+    prompts = [frozenset({reviews.ReviewPrompAspect.REFERENCE, level})
+               for level in text_prompt_levels]
+    read_aloud = frozenset({reviews.ReviewResponseAspect.READ_ALOUD})
+    now = int(time.time())
+    start = now - 2 * 365 * 86400
+    step = (now - start) // count
+    rows = []
+    for i in range(count):
+        r = Review(rnd.choice(references), start + i * step,
+                   rnd.choice(prompts), read_aloud,
+                   reviews.ReviewResult(rnd.choice(RESULTS)))
+        rows.append((ids[r.reference], r.uid, r.timestamp, 0,
+                     ",".join(sorted(a.value for a in r.prompt)),
+                     "read-aloud", r.result.value))
+        if len(rows) == 10000 or i == count - 1:
+            with reviews.db.atomic():
+                reviews.ReviewModel.insert_many(
+                    rows, fields=[reviews.ReviewModel.reference,
+                                  reviews.ReviewModel.uid,
+                                  reviews.ReviewModel.timestamp,
+                                  reviews.ReviewModel.utc_offset,
+                                  reviews.ReviewModel.prompt,
+                                  reviews.ReviewModel.response,
+                                  reviews.ReviewModel.result]).execute()
+            rows = []
+
+
+def _best(f, repeat=5, number=1):
+    """Fastest of repeat runs of f, per call."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            f()
+        elapsed = (time.perf_counter() - start) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def time_imports():
+    """Time importing memorize, run in a fresh process for each sample."""
+    results = {}
+    quiet = contextlib.redirect_stdout(io.StringIO())
+    start = time.perf_counter()
+    with quiet:
+        from memorize import reviews
+        reviews.setup_local_database()
+    results["import_reviews"] = time.perf_counter() - start
+    start = time.perf_counter()
+    with quiet:
+        from memorize import __main__  # noqa: F401
+        from memorize import prompt  # noqa: F401
+    results["import_app"] = time.perf_counter() - start
+    return results
+
+
+def measure():
+    """Time everything in the deck in the current directory."""
+    samples = [_child("imports", os.getcwd()) for _ in range(IMPORT_SAMPLES)]
+    results = {key: min(s[key] for s in samples) for key in samples[0]}
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        from memorize import reviews
+        from memorize import __main__ as app
+        from memorize import prompt
+
+    from memorize.diff import fuzzydiff, tokenize
+    from memorize.model import Review, text_prompt_levels
+
+    results["load_sqlite"] = _best(lambda: list(reviews.load_sqlite()))
+
+    def candidates():
+        with contextlib.redirect_stdout(io.StringIO()):
+            app.review_candidates()
+    results["review_candidates"] = _best(candidates)
+
+    rnd = random.Random(3)
+    references = list(reviews.verses)
+    texts = [reviews.verses[r] for r in references]
+    sample = rnd.sample(texts, min(200, len(texts)))
+    results["tokenize_verse"] = _best(
+        lambda: [tokenize(t) for t in sample]) / len(sample)
+
+    def recited(text):
+        words = text.split()
+        for _ in range(max(1, len(words) // 10)):
+            words[rnd.randrange(len(words))] = rnd.choice(WORDS)
+        return " ".join(words)
+    pairs = [(t, recited(t)) for t in sample[:50]]
+    results["fuzzydiff_verse"] = _best(
+        lambda: [fuzzydiff(t, g) for t, g in pairs]) / len(pairs)
+    chapter = " ".join(texts[:30])
+    chapter_recited = recited(chapter)
+    results["fuzzydiff_chapter"] = _best(
+        lambda: fuzzydiff(chapter, chapter_recited))
+
+    # The reference is left out, showing it sleeps.
+    prompts = [{level} for level in text_prompt_levels]
+    shown = [(r, p) for r in references[:20] for p in prompts]
+
+    def show():
+        with contextlib.redirect_stdout(io.StringIO()):
+            for r, p in shown:
+                prompt.show_prompt(r, p)
+    results["show_prompt"] = _best(show) / len(shown)
+
+    read_aloud = frozenset({reviews.ReviewResponseAspect.READ_ALOUD})
+    now = int(time.time())
+    saved = [Review(references[i % len(references)], now + i,
+                    frozenset({reviews.ReviewPrompAspect.BLIND}), read_aloud,
+                    reviews.ReviewResult.EASY) for i in range(1000)]
+    # Every run saves new reviews, a stored one is only looked up.
+    batches = iter([saved[i:i + 200] for i in range(0, len(saved), 200)])
+
+    def save():
+        for r in next(batches):
+            reviews.save_review(r)
+    results["save_review"] = _best(save) / 200
+    return results
+
+
+def _child(mode, directory, *args):
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), f"--{mode}", directory,
+         *args], check=True, capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def run_deck(name, keep=False):
+    verses, count = DECKS[name]
+    directory = tempfile.mkdtemp(prefix=f"memorize-{name}-")
+    try:
+        write_verses(os.path.join(directory, "verses.yaml"), verses,
+                     random.Random(1))
+        _child("generate", directory, str(count))
+        results = _child("measure", directory)
+    finally:
+        if not keep:
+            shutil.rmtree(directory)
+    return {"verses": verses, "reviews": count, "results": results}
+
+
+def compare(report, baseline, threshold):
+    """Print the change of every result, returning the regressions."""
+    regressions = []
+    for name, deck in report["decks"].items():
+        old = baseline["decks"].get(name)
+        if not old:
+            continue
+        for key, value in deck["results"].items():
+            before = old["results"].get(key)
+            if not before:
+                continue
+            change = value / before - 1
+            flag = ""
+            if change > threshold:
+                flag = "  REGRESSION"
+                regressions.append((name, key, change))
+            print(f"{name:8} {key:20} {before:10.6f}s -> {value:10.6f}s "
+                  f"{change:+7.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--decks", default="tiny,small,medium",
+                        help=f"comma separated, from {', '.join(DECKS)}")
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--compare", help="baseline JSON report")
+    parser.add_argument("--threshold", type=float, default=.2)
+    parser.add_argument("--keep", action="store_true",
+                        help="don't delete the generated decks")
+    parser.add_argument("--generate", help=argparse.SUPPRESS)
+    parser.add_argument("--measure", help=argparse.SUPPRESS)
+    parser.add_argument("--imports", help=argparse.SUPPRESS)
+    args, rest = parser.parse_known_args()
+
+    if args.generate or args.measure or args.imports:
+        sys.path.insert(0, ROOT)
+        os.chdir(args.generate or args.measure or args.imports)
+        with contextlib.redirect_stdout(io.StringIO()):
+            if args.generate:
+                generate(int(rest[0]))
+                results = {}
+            elif args.imports:
+                results = time_imports()
+            else:
+                results = measure()
+        print(json.dumps(results))
+        return
+
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                            capture_output=True, text=True).stdout.strip()
+    report = {
+        "commit": commit,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "decks": {},
+    }
+    for name in args.decks.split(","):
+        start = time.perf_counter()
+        report["decks"][name] = run_deck(name, args.keep)
+        print(f"{name}: measured in {time.perf_counter() - start:.0f}s",
+              file=sys.stderr)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            sys.exit(f"{len(regressions)} results regressed by more than "
+                     f"{args.threshold:.0%}")
+
+
+if __name__ == "__main__":
+    main()
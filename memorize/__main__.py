@@ -1,142 +1,72 @@
+import attr
 import pendulum
 import click
 import collections
+import datetime
 import time
-from pendulum import Duration, DateTime
+from pendulum import Duration
 import logging
+import os.path
 import readchar
 
-from . diff import fuzzydiff
+from . diff import fuzzydiff, LiveAlignment
 from . audio import get_audio
 
 
-from . reviews import (verses, ReviewPrompAspect,
-                       Review, Reference, ReviewResponseAspect, ReviewResult,
+from . reviews import (db, verses, catalog, ReviewPrompAspect,
+                       Review, ReviewResponseAspect, ReviewResult,
                        step_up_difficulty, step_down_difficulty,
                        deprecated_text_prompts,
-                       all_reviews, save_review)
+                       iter_reviews_by_reference, save_review, load_sqlite,
+                       export_yaml, export_json, save_schedule,
+                       update_schedule, save_transcript, save_transcripts,
+                       load_transcripts, reviews_for_reference,
+                       text_changed_references, reviews_after,
+                       last_review_id, setup_local_database,
+                       unscheduled_references)
+from . model import Transcript
 
 from . prompt import show_prompt, image_exists
-
-
-class ReviewScore:
-    def __init__(self, reference, reviews):
-        self.reference = reference
-        self.score = 1
-        self.review_bucket = 0
-        self.due = pendulum.now() - Duration(seconds=1)
-        self.frequency = Duration(hours=0)
-        self.last_easy = None
-        self.last_hard_or_failed = None
-        self.fails_in_a_row = 0
-        self.previous_easy = None
-        self.purgatory_countdown = 0
-        self.prompt = None
-        reviews.sort(key=lambda r: r.date)
-        prev = None
-        for r in reviews:
-            self.feed(r, prev)
-            prev = r
-            if reference == Reference("Rom", 8, 13, 13):
-                print(r.result, self.frequency, self.prompt)
-        self.finalize(reviews)
-
-    def feed(self, review, previous_review):
-        if review.result == ReviewResult.FAIL:
-            self.fails_in_a_row += 1
-            if self.purgatory_countdown:
-                self.purgatory_countdown = 5
-            elif self.fails_in_a_row == 2:
-                self.purgatory_countdown = 5
-        else:
-            self.fails_in_a_row = 0
-        if review.result == ReviewResult.EASY:
-            if self.purgatory_countdown:
-                self.purgatory_countdown -= 1
-        if self.purgatory_countdown:
-            self.prompt = {ReviewPrompAspect.REFERENCE,
-                           ReviewPrompAspect.FIRST_LETTERS}
-            self.frequency = Duration(hours=6)
-        else:
-            self.prompt = review.prompt
-
-        if self.frequency < Duration(hours=6):
-            self.frequency = Duration(hours=6)
-        if review.result == ReviewResult.FAIL:
-            self.last_hard_or_failed = review
-            self.frequency -= Duration(hours=6)
-            if self.frequency > Duration(days=1):
-                self.frequency *= .3
-        elif review.result == ReviewResult.HARD:
-            self.last_hard_or_failed = review
-            self.frequency -= Duration(hours=4)
-            if self.frequency > Duration(days=1):
-                self.frequency *= .7
-        elif review.result == ReviewResult.EASY:
-            self.last_easy = review
-            if self.previous_easy and (review.date - self.previous_easy.date) < Duration(hours=4):
-                self.previous_easy = review
-                return
-            self.previous_easy = review
-            if ReviewPrompAspect.BLIND in review.prompt:
-                self.frequency += Duration(hours=24)
-                if previous_review and previous_review.result == ReviewResult.EASY:
-                    a = pendulum.instance(previous_review.date)
-                    b = pendulum.instance(review.date)
-                    d = b.diff(a) * 1.32
-                    if d > self.frequency:
-                        self.frequency = d
-            elif ReviewPrompAspect.FIRST_WORD in review.prompt:
-                self.frequency += Duration(hours=12)
-            elif ReviewPrompAspect.FIRST_LETTERS in review.prompt:
-                self.frequency = Duration(hours=6)
-            elif ReviewPrompAspect.ENDING_UNDERSCORE in review.prompt:
-                self.frequency = Duration(hours=6)
-
-    def finalize(self, reviews):
-        self.review_bucket = 5
-        if self.frequency < Duration(days=3):
-            self.review_bucket = 2
-        elif self.frequency < Duration(weeks=1):
-            self.review_bucket = 3
-        elif self.frequency < Duration(weeks=3):
-            self.review_bucket = 4
-        if self.last_easy:
-            self.due_date = self.last_easy.date + self.frequency
-        else:
-            self.score = 1
-            self.review_bucket = 1
-            self.due_date = pendulum.now() - Duration(seconds=1)
-            return
-        if self.last_hard_or_failed:
-            min_due_date = self.last_hard_or_failed.date + Duration(hours=2)
-            if min_due_date > self.due_date:
-                self.due_date = min_due_date
-            if self.last_easy and self.last_easy.date < self.last_hard_or_failed.date:
-                self.review_bucket = 1
-        now = pendulum.now()
-        if self.last_easy:
-            self.ratio = (now - self.last_easy.date) / \
-                (self.due_date - self.last_easy.date)
-        else:
-            self.review_bucket = 0
-            self.ratio = 0
-        if now > self.due_date:
-            self.score = 10 + (now - self.due_date).days
-        else:
-            self.score = 0
+from . schedule import ReviewScore, DEFAULT_RULES
+from . reviewlog import ReviewLog
+from . sync import merge
+from . regrade import (parse_mem_log, regrade, print_report,
+                      TRANSCRIPTS_STORED)
+from . import stats
+
+# Optional append-only log kept alongside reviews.db, see `log-init`.
+REVIEW_LOG = "reviews.log"
+review_log = None
+
+
+def open_review_log():
+    """Open reviews.log if there is one, with the reviews stored without it.
+
+    The server, import_yaml and others store reviews in reviews.db only.
+    """
+    if not os.path.exists(REVIEW_LOG):
+        return None
+    log = ReviewLog(REVIEW_LOG)
+    log.recover()
+    with db.atomic("DEFERRED"):
+        missing = list(reviews_after(log.synced))
+        position = last_review_id()
+    added = log.catch_up(missing, position)
+    if added:
+        print(f"Appended {added} reviews to {REVIEW_LOG}")
+    return log
 
 
 def print_frequencies(frequencies):
     for reference, frequency in sorted(frequencies.items()):
+        frequency = Duration(seconds=frequency)
         print(reference, frequency.days, "days,", frequency.hours, "hours")
 
 
-def print_date_histogram(dates: list[DateTime]):
-    import collections
+def print_date_histogram(timestamps: list[int]):
     by_date = collections.defaultdict(lambda: 0)
-    for d in dates:
-        by_date[d.date()] += 1
+    for t in timestamps:
+        by_date[datetime.date.fromtimestamp(t)] += 1
     for date, count in sorted(by_date.items()):
         print(date, count)
 
@@ -151,27 +81,40 @@ def print_review_buckets(scores: list[ReviewScore]):
             print(f"   {s.reference}")
 
 
-def review_candidates():
-    reviews_by_reference = {}
-    for reference in verses:
-        reviews_by_reference[reference] = []
+def score_references():
+    if review_log:
+        now = int(time.time())
+        recovered = review_log.scores
+        scores = {}
+        for reference in verses:
+            score = recovered.get(reference)
+            if score:
+                score.finalize(now)
+            else:
+                score = ReviewScore(reference, [], now)
+            scores[reference] = score
+        # The log has every review, not just those of the current text.
+        for reference in text_changed_references() & scores.keys():
+            scores[reference] = ReviewScore(
+                reference, list(reviews_for_reference(reference)), now)
+        return scores
+
+    scores = {}
+    for reference, reviews in iter_reviews_by_reference():
+        if reference in verses:
+            scores[reference] = ReviewScore(reference, reviews)
+    save_schedule(scores.values())
+    return {reference: scores.get(reference) or ReviewScore(reference, [])
+            for reference in verses}
 
-    for review in all_reviews:
-        try:
-            reviews_by_reference[review.reference].append(review)
-        except KeyError:
-            pass
 
-    scores_by_reference = {}
+def review_candidates():
     results = []
     due_dates = []
     frequencies = {}
-    for reference, reviews in reviews_by_reference.items():
-        reviews.sort(key=lambda r: r.date)
-        score = ReviewScore(reference, reviews)
+    for reference, score in score_references().items():
         frequencies[reference] = score.frequency
         due_dates.append(score.due_date)
-        scores_by_reference[reference] = score
         if score.score:
             results.append(score)
     print_frequencies(frequencies)
@@ -201,56 +144,65 @@ def do_override_prompt(result):
         return result
 
 
-def get_audio_with_result(ref):
-    def test(text):
-        diffres = fuzzydiff(verses[ref], text)
-        return not diffres.appears_unfinished()
-
-    audio_res = get_audio(test)
-
-    diffres = fuzzydiff(verses[ref], audio_res)
+def grade_recitation(ref, audio_res):
+    diffres = fuzzydiff(verses[ref], audio_res, catalog.tokens(ref))
 
     diffres.print()
 
     score = diffres.score()
-    if score > 0.96:
-        res = ReviewResult.EASY
-    elif score > 0.92:
-        res = ReviewResult.HARD
-    else:
-        res = ReviewResult.FAIL
+    res = DEFAULT_RULES.grade(score)
 
     logging.info(f"score: {score} result: {res}")
     print(res)
 
+    transcript = Transcript(ref, int(time.time()), verses[ref], audio_res,
+                            score, res)
+
     if res != ReviewResult.EASY:
         res = do_override_prompt(res)
 
-    return res
+    return res, transcript
 
 
-def do_review(ref, prompt, save=True):
-    print("")
+def get_audio_with_result(ref):
+    def test(text):
+        diffres = fuzzydiff(verses[ref], text, catalog.tokens(ref))
+        return not diffres.appears_unfinished()
 
-    show_prompt(ref, prompt)
+    audio_res = get_audio(test, LiveAlignment(catalog.tokens(ref)))
+    return grade_recitation(ref, audio_res)
 
-    res = get_audio_with_result(ref)
 
-    r = Review(
+def record_review(ref, prompt, res, transcript):
+    r = Review.from_date(
         reference=ref,
         date=pendulum.now(),
-        prompt=prompt,
-        response={ReviewResponseAspect.READ_ALOUD},
+        prompt=frozenset(prompt),
+        response=frozenset({ReviewResponseAspect.READ_ALOUD}),
         result=res
     )
+    save_review(r)
+    if review_log:
+        review_log.append(r)
+    update_schedule([ref])
+    save_transcript(transcript, r)
+
+
+def do_review(ref, prompt, save=True):
+    print("")
+
+    show_prompt(ref, prompt)
+
+    res, transcript = get_audio_with_result(ref)
+
     if save:
-        save_review(r)
+        record_review(ref, prompt, res, transcript)
 
     original_res = res
 
     while res != ReviewResult.EASY:
         time.sleep(2)
-        res = get_audio_with_result(ref)
+        res, _ = get_audio_with_result(ref)
 
     return original_res
 
@@ -284,9 +236,20 @@ def do_increasing_difficulty_review(score: ReviewScore):
         prompt = new_prompt
 
 
-@ click.command()
+@ click.group(invoke_without_command=True)
+@ click.pass_context
+def cli(ctx):
+    setup_local_database()
+    if ctx.invoked_subcommand is None:
+        ctx.invoke(review)
+
+
+@ cli.command()
 @ click.option("--count", default=20)
 def review(count: int):
+    global review_log
+    review_log = open_review_log()
+    logging.info(TRANSCRIPTS_STORED)
     candidates = review_candidates()
     num_due = 0
     num_new = 0
@@ -303,7 +266,143 @@ def review(count: int):
         do_increasing_difficulty_review(score)
 
 
+@ cli.command()
+@ click.option("--save/--no-save", default=True)
+def recall(save):
+    """Recite any verse without a prompt, it is recognized and graded."""
+    global review_log
+    review_log = open_review_log()
+    logging.info(TRANSCRIPTS_STORED)
+    index = catalog.phonetic()
+
+    def test(text):
+        matches = index.lookup(text, limit=1)
+        if not matches:
+            return False
+        ref, _ = matches[0]
+        return not fuzzydiff(verses[ref], text,
+                             catalog.tokens(ref)).appears_unfinished()
+
+    print("Recite a verse")
+    audio_res = get_audio(test)
+    matches = index.lookup(audio_res)
+    if not matches:
+        print("No verse recognized")
+        return
+    ref, _ = matches[0]
+    print(ref)
+    if len(matches) > 1:
+        print("  also close:", ", ".join(str(r) for r, _ in matches[1:]))
+    res, transcript = grade_recitation(ref, audio_res)
+    if save:
+        record_review(ref, {ReviewPrompAspect.BLIND}, res, transcript)
+
+
+@ cli.command("log-init")
+def log_init():
+    """Create reviews.log from reviews.db."""
+    with db.atomic("DEFERRED"):
+        ReviewLog.create(REVIEW_LOG, load_sqlite(), last_review_id())
+    print(f"Wrote {REVIEW_LOG}")
+
+
+@ cli.command("merge")
+@ click.argument("other", type=click.Path(exists=True, dir_okay=False))
+def merge_command(other):
+    """Exchange new reviews with another reviews.db or reviews.log."""
+    log = open_review_log()
+    pulled, pushed, affected = merge(other, log)
+    update_schedule(affected)
+    if log:
+        log.snapshot()
+    print(f"Pulled {pulled} and pushed {pushed} reviews, "
+          f"rescheduled {len(affected)} references")
+
+
+@ cli.command("import-transcripts")
+@ click.argument("log", type=click.File("rt"), default="mem.log")
+def import_transcripts(log):
+    """Store the graded recitations found in mem.log as transcripts.
+
+    Only the recitations from before transcripts were stored as they were
+    graded are imported.
+    """
+    references_by_text = {text: ref for ref, text in verses.items()}
+    added = save_transcripts(parse_mem_log(log, references_by_text))
+    print(f"Imported {added} transcripts")
+
+
+@ cli.command("regrade")
+@ click.option("--easy-cutoff", default=DEFAULT_RULES.easy_cutoff)
+@ click.option("--hard-cutoff", default=DEFAULT_RULES.hard_cutoff)
+@ click.option("--workers", type=int)
+def regrade_command(easy_cutoff, hard_cutoff, workers):
+    """Grade every stored transcript again and report what changed."""
+    rules = attr.evolve(DEFAULT_RULES, easy_cutoff=easy_cutoff,
+                        hard_cutoff=hard_cutoff)
+    start = time.perf_counter()
+    transcripts = dict(load_transcripts())
+    scores = regrade(transcripts.items(), workers)
+    print_report(transcripts, scores, rules)
+    print(f"Regraded in {time.perf_counter() - start:.1f}s")
+
+
+def _timed(title, query, *args):
+    start = time.perf_counter()
+    rows = query(*args)
+    elapsed = (time.perf_counter() - start) * 1000
+    print(f"{title} ({elapsed:.1f} ms):")
+    return rows
+
+
+@ cli.command("stats")
+@ click.option("--days", default=30, help="days of review history")
+@ click.option("--forecast", default=14, help="days of due verses")
+@ click.option("--limit", default=10, help="slowest verses to list")
+def stats_command(days, forecast, limit):
+    """Summarize reviews.db without replaying the reviews."""
+    # review only scores every verse without reviews.log, and not before
+    # its first session since the schedule was added.
+    unscheduled = unscheduled_references() & verses.keys()
+    if unscheduled:
+        update_schedule(unscheduled)
+    for date, count, fails in _timed("Reviews per day",
+                                     stats.reviews_per_day, days):
+        print(f"  {date} {count:5} reviews {fails:4} failed")
+    for book, count, rate in _timed("Fail rate by book",
+                                    stats.fail_rate_by_book):
+        print(f"  {book:10} {rate:6.1%} of {count}")
+    for level, count, rate in _timed("Fail rate by prompt level",
+                                     stats.fail_rate_by_prompt_level):
+        print(f"  {level:18} {rate:6.1%} of {count}")
+    for date, due in _timed("Due forecast", stats.due_forecast, forecast):
+        print(f"  {date} {due:5}")
+    for reference, count, fails, hards, frequency in _timed(
+            "Slowest to learn", stats.slowest_to_learn, limit):
+        frequency = Duration(seconds=frequency or 0)
+        print(f"  {str(reference):16} {count:4} reviews, {fails} failed, "
+              f"{hards} hard, every {frequency.days} days")
+
+
+@ cli.command()
+@ click.option("--format", "fmt", type=click.Choice(["yaml", "json"]),
+               default="yaml")
+@ click.option("--source", type=click.Choice(["sqlite", "log"]),
+               default="sqlite")
+@ click.argument("output", type=click.File("wt"), default="-")
+def export(fmt, source, output):
+    """Stream all reviews to OUTPUT."""
+    if source == "log":
+        reviews = iter(ReviewLog(REVIEW_LOG))
+    else:
+        reviews = load_sqlite()
+    if fmt == "json":
+        export_json(reviews, output)
+    else:
+        export_yaml(reviews, output)
+
+
 if __name__ == "__main__":
     logging.basicConfig(filename="mem.log",
                         encoding="utf-8", level=logging.INFO)
-    review()
+    cli()
@@ -1,18 +1,28 @@
-import vosk
+import functools
 import sounddevice as sd
 import sys
 import queue
-import json
+import time
 import logging
 
-model = vosk.Model("model")
+from . speech import open_stream
 
-device_info = sd.query_devices(None, 'input')
-# soundfile expects an int, sounddevice provides a float:
-samplerate = int(device_info['default_samplerate'])
 
+@functools.cache
+def input_samplerate():
+    device_info = sd.query_devices(None, 'input')
+    # soundfile expects an int, sounddevice provides a float:
+    return int(device_info['default_samplerate'])
 
-def get_audio(test_finished):
+
+def get_audio(test_finished, live=None, min_interval=.2):
+    """Listen until test_finished accepts the final segments so far.
+
+    With a LiveAlignment, partial results also show progress and end the
+    capture as soon as the whole verse has been heard. Partials are
+    aligned at most every min_interval seconds and only while no audio is
+    waiting to be decoded.
+    """
     q = queue.Queue()
     so_far = []
 
@@ -22,34 +32,51 @@ def get_audio(test_finished):
             print(status, file=sys.stderr)
         q.put(bytes(indata))
 
+    samplerate = input_samplerate()
     with sd.RawInputStream(samplerate=samplerate, blocksize=8000,
                            dtype='int16',
                            channels=1, callback=callback):
         sys.stdout.write("\n")
         sys.stdout.write("listening...\r")
         sys.stdout.flush()
-        rec = vosk.KaldiRecognizer(model, samplerate)
-        rec.SetMaxAlternatives(5)
-        empty_partial_count = 0
-        while True:
-            data = q.get()
-            if rec.AcceptWaveform(data):
-                res = json.loads(rec.Result())
-                logging.info(f"alternatives: {res['alternatives']}")
-                so_far.append(res["alternatives"][0]["text"])
-                empty_partial_count = 0
-                if test_finished(" ".join(so_far)):
-                    break
-                sys.stdout.write("listening for more...\r")
-            else:
-                partial = json.loads(rec.PartialResult())["partial"]
-                if so_far and len(so_far) > 3 and not partial:
-                    empty_partial_count += 1
-                    if empty_partial_count > 40:
+        stream = open_stream(samplerate, alternatives=5)
+        try:
+            empty_partial_count = 0
+            last_partial = ""
+            last_update = 0
+            while True:
+                data = q.get()
+                res = stream.accept(data)
+                if "partial" not in res:
+                    logging.info(f"alternatives: {res['alternatives']}")
+                    text = res["alternatives"][0]["text"]
+                    so_far.append(text)
+                    if live:
+                        live.commit(text)
+                    empty_partial_count = 0
+                    if test_finished(" ".join(so_far)):
                         break
-                # if partial:
-                # sys.stdout.write(f"{partial[-79:]}\r")
-                # sys.stdout.flush()
+                    sys.stdout.write("listening for more...\r")
+                else:
+                    partial = res["partial"]
+                    if so_far and len(so_far) > 3 and not partial:
+                        empty_partial_count += 1
+                        if empty_partial_count > 40:
+                            break
+                    now = time.monotonic()
+                    if (live and partial and partial != last_partial
+                            and now - last_update >= min_interval
+                            and q.empty()):
+                        last_partial = partial
+                        last_update = now
+                        if live.update(partial):
+                            logging.info(f"accepted partial: {partial}")
+                            so_far.append(partial)
+                            break
+                        sys.stdout.write(f"{live.progress():<79}\r")
+                        sys.stdout.flush()
+        finally:
+            stream.close()
         sys.stdout.write(" " * 79 + "\r")
         sys.stdout.flush()
         return " ".join(so_far)
@@ -0,0 +1,154 @@
+"""verses.yaml, parsed once and kept up to date between runs.
+
+The parsed verses are saved in a manifest with a content hash per verse.
+While verses.yaml keeps its size and modification time, loading is a stat
+and reading the manifest. After an edit the verses are diffed by hash, so
+derived data only has to be redone for the verses that were added,
+changed or removed.
+"""
+import hashlib
+import os
+import pickle
+
+import yaml
+from nltk.tokenize import word_tokenize
+
+from . diff import tokenize
+from . model import Reference
+from . phonetic import PhoneticIndex
+
+VERSION = 1
+
+# Parsing with libyaml is an order of magnitude faster when available.
+_Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def prompt_words(text):
+    """The words of text that prompts are made of."""
+    for c in "“”":
+        text = text.replace(c, '"')
+    text = text.replace("—", " — ")
+    return word_tokenize(text)
+
+
+def _read(path):
+    try:
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+    except (OSError, EOFError, AttributeError, pickle.UnpicklingError):
+        return None
+    if data.get("version") != VERSION:
+        return None
+    return data
+
+
+def _write(path, data):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(dict(data, version=VERSION), f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+class Catalog:
+
+    def __init__(self, path="verses.yaml"):
+        self.path = path
+        self.manifest_path = path + ".manifest"
+        self.phonetic_path = path + ".phonetic"
+        self.verses = {}
+        self.hashes = {}
+        self.added = set()
+        self.changed = set()
+        self.removed = set()
+        self.dirty = False
+        self._source = None
+        self._tokens = {}
+        self._words = {}
+        self._phonetic = None
+
+    @classmethod
+    def load(cls, path="verses.yaml"):
+        catalog = cls(path)
+        catalog.refresh()
+        return catalog
+
+    def refresh(self):
+        """Load the verses, parsing verses.yaml only if it was modified."""
+        st = os.stat(self.path)
+        source = (st.st_mtime_ns, st.st_size)
+        manifest = _read(self.manifest_path)
+        if manifest and manifest["source"] == source:
+            self.verses = manifest["verses"]
+            self.hashes = manifest["hashes"]
+            return
+
+        with open(self.path, encoding="utf-8") as f:
+            parsed = yaml.load(f, Loader=_Loader) or {}
+        self.verses = {Reference.parse(k): v for k, v in parsed.items()}
+        self.hashes = {r: text_hash(v) for r, v in self.verses.items()}
+        self._source = source
+        self.dirty = True
+        if not manifest:
+            return
+        old = manifest["hashes"]
+        self.added = self.hashes.keys() - old.keys()
+        self.removed = old.keys() - self.hashes.keys()
+        self.changed = {r for r, h in self.hashes.items()
+                        if r in old and old[r] != h}
+
+    def save(self):
+        """Write the manifest if verses.yaml was parsed."""
+        if not self.dirty:
+            return
+        _write(self.manifest_path, {"source": self._source,
+                                    "verses": self.verses,
+                                    "hashes": self.hashes})
+        self.dirty = False
+
+    def tokens(self, reference):
+        """diff.tokenize of a verse, tokenized on first use."""
+        tokens = self._tokens.get(reference)
+        if tokens is None:
+            tokens = self._tokens[reference] = tokenize(
+                self.verses[reference])
+        return tokens
+
+    def words(self, reference):
+        """prompt_words of a verse, split on first use."""
+        words = self._words.get(reference)
+        if words is None:
+            words = self._words[reference] = prompt_words(
+                self.verses[reference])
+        return words
+
+    def phonetic(self):
+        """The PhoneticIndex of every verse.
+
+        The index is saved with the hashes it was built from and only the
+        verses whose hash differs are indexed again.
+        """
+        if self._phonetic is not None:
+            return self._phonetic
+        saved = _read(self.phonetic_path)
+        if saved:
+            index, hashes = saved["index"], saved["hashes"]
+        else:
+            index, hashes = PhoneticIndex(), {}
+        stale = False
+        for reference in hashes.keys() - self.hashes.keys():
+            index.remove(reference)
+            stale = True
+        for reference, h in self.hashes.items():
+            if hashes.get(reference) != h:
+                index.add(reference, self.tokens(reference))
+                stale = True
+        if stale:
+            _write(self.phonetic_path, {"index": index,
+                                        "hashes": self.hashes})
+        self._phonetic = index
+        return index
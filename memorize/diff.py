@@ -1,5 +1,6 @@
 import attr
 import difflib
+import functools
 import metaphone
 from fuzzywuzzy import fuzz
 import contractions
@@ -11,6 +12,10 @@ fudge_pairs = [
     {"his", "the"},
 ]
 
+# The same few thousand words come up over and over again.
+doublemetaphone = functools.lru_cache(maxsize=1 << 16)(
+    metaphone.doublemetaphone)
+
 
 @enum.unique
 class ChunkType(enum.Enum):
@@ -65,7 +70,7 @@ def tokenize(s):
     tokens = []
     for t in contractions.fix(s).split():
         normalized = t.lower().replace("'", '').replace('\"', '')
-        dmeta = metaphone.doublemetaphone(normalized)
+        dmeta = doublemetaphone(normalized)
         tokens.append(Token(original=t,
                             normalized=normalized,
                             dmeta=dmeta))
@@ -130,6 +135,65 @@ class DiffResult:
         print_diff_chunks(self.chunks)
 
 
+class LiveAlignment:
+    """Follow a recitation through the expected verse as it is heard.
+
+    Rather than a full diff, each recognized word is matched against the
+    next few expected words, so an update only costs a pass over the words
+    heard since the last final segment.
+
+    >>> live = LiveAlignment(tokenize("in the beginning was the word"))
+    >>> live.update("in the beginning was")
+    False
+    >>> live.update("in the beginning was the word")
+    True
+    """
+
+    def __init__(self, expected_tokens, window=4, tail=3, coverage=.9):
+        self.expected = [t.diffable() for t in expected_tokens]
+        self.window = window
+        self.tail = min(tail, len(self.expected))
+        self.coverage = coverage
+        # (expected words consumed, words matched, consecutive matches)
+        self.committed = (0, 0, 0)
+        self.state = self.committed
+
+    def _advance(self, state, text):
+        position, matched, run = state
+        for t in tokenize(text):
+            key = t.diffable()
+            end = min(len(self.expected), position + self.window)
+            for i in range(position, end):
+                if self.expected[i] == key:
+                    run = run + 1 if i == position else 1
+                    matched += 1
+                    position = i + 1
+                    break
+        return position, matched, run
+
+    def commit(self, text):
+        """Add a final segment."""
+        self.committed = self.state = self._advance(self.committed, text)
+
+    def update(self, partial):
+        """Align the current partial hypothesis, returning True once the
+        end of the verse has been recited."""
+        self.state = self._advance(self.committed, partial)
+        return self.finished()
+
+    def finished(self):
+        position, matched, run = self.state
+        return (position == len(self.expected)
+                and run >= self.tail
+                and matched >= self.coverage * len(self.expected))
+
+    def progress(self, width=40):
+        position, matched, _ = self.state
+        total = len(self.expected)
+        done = width * position // total if total else width
+        return f"[{'#' * done}{'.' * (width - done)}] {matched}/{total} words"
+
+
 def print_diff_chunks(outputs, line_width=80):
     width = 0
     chunks = []
@@ -163,8 +227,8 @@ def fudge(expected_tokens, got_tokens) -> FudgeType:
     expected_metaphone = "".join(t.dmeta[0] for t in expected_tokens)
     got_metaphone = "".join(t.dmeta[0] for t in got_tokens)
     ratio = fuzz.ratio(expected_metaphone, got_metaphone)
-    logging.info(
-        f"fudge expected:{expected_tokens} got:{got_tokens} ratio:{ratio}")
+    logging.info("fudge expected:%s got:%s ratio:%s",
+                 expected_tokens, got_tokens, ratio)
 
     if ratio >= 85:
         return FudgeType.EQUAL
@@ -184,7 +248,7 @@ def fudge(expected_tokens, got_tokens) -> FudgeType:
     return FudgeType.BAD
 
 
-def fuzzydiff(expected, got):
+def fuzzydiff(expected, got, expected_tokens=None):
     """
     >>> fuzzydiff("who is", "who's").int_score()
     100
@@ -196,9 +260,12 @@ def fuzzydiff(expected, got):
     >>> fuzzydiff("i want all of you to share",
     ...     "i want all of you you too  share").int_score()
     100
+
+    `expected_tokens` can be passed to skip tokenizing the same verse again.
     """
-    logging.info(f"fuzzydiff({repr(expected)}, {repr(got)})")
-    expected_tokens = tokenize(expected)
+    logging.info("fuzzydiff(%r, %r)", expected, got)
+    if expected_tokens is None:
+        expected_tokens = tokenize(expected)
     got_tokens = tokenize(got)
 
     sm = difflib.SequenceMatcher(None,
@@ -246,7 +313,7 @@ def fuzzydiff(expected, got):
         logging.info("fuzzydiff: removing starting fudge word")
         outputs = outputs[1:]
 
-    logging.debug(f"fuzzydiff chunks: {outputs}")
+    logging.debug("fuzzydiff chunks: %s", outputs)
 
     return DiffResult(chunks=outputs)
 
@@ -0,0 +1,208 @@
+import attr
+import cattr
+import cattr.preconf.json
+import re
+import enum
+import hashlib
+import pendulum
+from typing import FrozenSet, Optional
+
+
+@attr.frozen(order=True)
+class Reference:
+    book: str
+    chapter: int
+    verse: int
+    verse_end: int
+
+    @classmethod
+    def parse(cls, s):
+        m = re.match(r"(\d?\s?\w+)\s+(\d+):(\d+)-(\d+)", s)
+        if m:
+            book, chapter, verse, verse_end = m.groups()
+            return Reference(book, int(chapter), int(verse), int(verse_end))
+        else:
+            m = re.match(r"(\d?\s?\w+)\s+(\d+):(\d+)", s)
+            book, chapter, verse = m.groups()
+            return Reference(book, int(chapter), int(verse), int(verse))
+
+    def __str__(self):
+        if self.verse != self.verse_end:
+            return f"{self.book} {self.chapter}:{self.verse}-{self.verse_end}"
+        else:
+            return f"{self.book} {self.chapter}:{self.verse}"
+
+    def verse_count(self):
+        return self.verse_end - self.verse + 1
+
+
+@enum.unique
+class ReviewPrompAspect(enum.Enum):
+    REFERENCE = "reference"
+    IMAGE = "image"
+    FULL_TEXT = "full-text"
+    MIDDLE_UNDERSCORE = "middle-underscore"
+    ENDING_UNDERSCORE = "ending-underscore"
+    FIRST_LETTERS = "first-letters"
+    FIRST_LETTERS_1 = "first-letters-1"
+    FIRST_LETTERS_2 = "first-letters-2"
+    FIRST_LETTERS_3 = "first-letters-3"
+    FIRST_LETTERS_4 = "first-letters-4"
+    FIRST_LETTERS_5 = "first-letters-5"
+    FIRST_WORD = "first-word"
+    BLIND = "blind"
+
+
+text_prompt_levels = [
+    ReviewPrompAspect.FULL_TEXT,
+    ReviewPrompAspect.ENDING_UNDERSCORE,
+    ReviewPrompAspect.FIRST_LETTERS,
+    ReviewPrompAspect.FIRST_LETTERS_1,
+    ReviewPrompAspect.FIRST_LETTERS_2,
+    ReviewPrompAspect.FIRST_LETTERS_3,
+    ReviewPrompAspect.FIRST_LETTERS_4,
+    ReviewPrompAspect.FIRST_LETTERS_5,
+    ReviewPrompAspect.FIRST_WORD,
+    ReviewPrompAspect.BLIND,
+]
+
+deprecated_text_prompts = {}
+
+
+def step_down_difficulty(aspects):
+    new_aspects = set()
+    non_text_prompt_aspects = set()
+    text_level_found = False
+    for a in aspects:
+        if a in text_prompt_levels:
+            text_level_found = True
+            index = text_prompt_levels.index(a)
+            index -= 1
+            if index < 0:
+                index = 0
+            # Assumes that the min is not deprecated
+            while text_prompt_levels[index] in deprecated_text_prompts:
+                index -= 1
+            new_aspects.add(text_prompt_levels[index])
+        else:
+            non_text_prompt_aspects.add(a)
+    if not text_level_found:
+        new_aspects.add(text_prompt_levels[0])
+    new_aspects.update(non_text_prompt_aspects)
+    return new_aspects
+
+
+def step_up_difficulty(aspects):
+    new_aspects = set()
+    # First, find the text prompt
+    text_level_maxed = False
+    text_level_found = False
+    non_text_prompt_aspects = set()
+    for a in aspects:
+        if a in text_prompt_levels:
+            text_level_found = True
+            index = text_prompt_levels.index(a)
+            index += 1
+            if index >= len(text_prompt_levels):
+                index = len(text_prompt_levels) - 1
+                text_level_maxed = True
+            # Assumes that that the max is not depricated
+            while text_prompt_levels[index] in deprecated_text_prompts:
+                index += 1
+            new_aspects.add(text_prompt_levels[index])
+        else:
+            non_text_prompt_aspects.add(a)
+    if not text_level_found:
+        new_aspects.add(text_prompt_levels[0])
+    new_aspects.add(ReviewPrompAspect.REFERENCE)
+    new_aspects.update(non_text_prompt_aspects)
+    if text_level_maxed:
+        new_aspects.discard(ReviewPrompAspect.IMAGE)
+    return new_aspects
+
+
+@enum.unique
+class ReviewResponseAspect(enum.Enum):
+    READ_ALOUD = "read-aloud"
+
+
+@enum.unique
+class ReviewResult(enum.Enum):
+    FAIL = "fail"
+    HARD = "hard"
+    EASY = "easy"
+
+
+@attr.frozen(order=True)
+class Review:
+    reference: Reference
+    # Seconds since the epoch, the UTC offset is only needed for display.
+    timestamp: int
+    prompt: FrozenSet[ReviewPrompAspect]
+    response: FrozenSet[ReviewResponseAspect]
+    result: ReviewResult
+    utc_offset: int = 0
+
+    @classmethod
+    def from_date(cls, reference, date, prompt, response, result):
+        return Review(reference, date.int_timestamp, prompt, response, result,
+                      date.offset)
+
+    @property
+    def date(self):
+        return pendulum.from_timestamp(
+            self.timestamp, tz=pendulum.FixedTimezone(self.utc_offset))
+
+    @property
+    def uid(self):
+        """Content hash identifying the review across devices."""
+        text = "|".join([str(self.reference),
+                         str(self.timestamp),
+                         ",".join(sorted(e.value for e in self.prompt)),
+                         ",".join(sorted(e.value for e in self.response)),
+                         self.result.value])
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _structure_review(d, _):
+    date = d["date"]
+    if isinstance(date, str):
+        date = pendulum.parse(date)
+    else:
+        date = pendulum.instance(date)
+    return Review.from_date(
+        converter.structure(d["reference"], Reference),
+        date,
+        converter.structure(d["prompt"], FrozenSet[ReviewPrompAspect]),
+        converter.structure(d["response"], FrozenSet[ReviewResponseAspect]),
+        ReviewResult(d["result"]))
+
+
+def _unstructure_review(r):
+    return {
+        "reference": str(r.reference),
+        "date": r.date.isoformat(),
+        "prompt": [e.value for e in r.prompt],
+        "response": [e.value for e in r.response],
+        "result": r.result.value,
+    }
+
+
+converter = cattr.preconf.json.make_converter()
+converter.register_structure_hook(
+    Reference, lambda s, _: Reference.parse(s))
+converter.register_unstructure_hook(Reference, lambda r: str(r))
+converter.register_structure_hook(Review, _structure_review)
+converter.register_unstructure_hook(Review, _unstructure_review)
+
+
+@attr.frozen
+class Transcript:
+    """What was recognized for a recitation and how it was graded."""
+    reference: Reference
+    # None for transcripts recovered from mem.log, which has no dates.
+    timestamp: Optional[int]
+    expected: str
+    text: str
+    score: float
+    result: ReviewResult
@@ -0,0 +1,141 @@
+import array
+import collections
+import heapq
+import math
+
+from . diff import tokenize
+
+# Consecutive sounds indexed, shorter n-grams survive recognition errors
+# better while longer ones narrow down the verse faster.
+NGRAMS = (2, 3)
+# Postings are packed as verse index << 8 | word position.
+_POSITION_BITS = 8
+_MAX_POSITION = (1 << _POSITION_BITS) - 1
+
+
+def _grams(keys):
+    for n in NGRAMS:
+        for i in range(len(keys) - n + 1):
+            yield i, " ".join(keys[i:i + n])
+
+
+def _keys(tokens):
+    return [t.diffable() for t in tokens]
+
+
+class PhoneticIndex:
+    """Inverted index from doublemetaphone n-grams to verses.
+
+    Used to tell which verse is being recited from the first few words
+    heard, before there is a reference to grade against.
+
+    >>> from memorize.model import Reference
+    >>> index = PhoneticIndex({Reference.parse(r): text for r, text in [
+    ...     ("1 John 1:5", "God is light, and in him is no darkness at all."),
+    ...     ("1 John 4:8", "Anyone who does not love does not know God, "
+    ...                    "because God is love."),
+    ...     ("1 John 4:16", "God is love, and whoever abides in love "
+    ...                     "abides in God.")]})
+    >>> [str(r) for r, _ in index.lookup("god is love")]
+    ['1 John 4:16', '1 John 4:8', '1 John 1:5']
+
+    A removed verse is never found, even once the index is pickled.
+
+    >>> import pickle
+    >>> index.remove(Reference.parse("1 John 4:16"))
+    >>> [str(r) for r, _ in index.lookup("god is love", limit=1)]
+    ['1 John 4:8']
+    >>> [str(r) for r, _ in pickle.loads(pickle.dumps(index)).lookup(
+    ...     "god is love")]
+    ['1 John 4:8', '1 John 1:5']
+    """
+
+    def __init__(self, verses=None, tokens=None):
+        """Index verses, a {reference: text} dict. Already tokenized verses
+        can be passed as tokens, a {reference: [Token]} dict."""
+        self.references = []
+        # Index of each reference in self.references
+        self.slots = {}
+        self.postings = {}
+        # Postings of an unpickled index, see __getstate__.
+        self._packed_ids = {}
+        self._offsets = array.array("Q", [0])
+        self._packed = array.array("I")
+        tokens = tokens or {}
+        for reference, text in (verses or {}).items():
+            verse_tokens = tokens.get(reference)
+            if verse_tokens is None:
+                verse_tokens = tokenize(text)
+            self.add(reference, verse_tokens)
+
+    def add(self, reference, tokens):
+        if reference in self.slots:
+            self.remove(reference)
+        index = len(self.references)
+        self.references.append(reference)
+        self.slots[reference] = index
+        for position, gram in _grams(_keys(tokens)):
+            postings = self.postings.get(gram)
+            if postings is None:
+                postings = self.postings[gram] = array.array("I")
+            postings.append(
+                index << _POSITION_BITS | min(position, _MAX_POSITION))
+
+    def remove(self, reference):
+        """Forget reference, its postings stay behind but never match."""
+        index = self.slots.pop(reference)
+        self.references[index] = None
+
+    def _postings(self, gram):
+        postings = self.postings.get(gram)
+        i = self._packed_ids.get(gram)
+        if i is None:
+            return postings
+        packed = self._packed[self._offsets[i]:self._offsets[i + 1]]
+        return packed + postings if postings else packed
+
+    def __getstate__(self):
+        # Unpickling hundreds of thousands of small arrays is slow, so the
+        # postings are saved as one array with the offsets of each n-gram.
+        grams = list(self._packed_ids.keys() | self.postings.keys())
+        offsets = array.array("Q", [0])
+        packed = array.array("I")
+        for gram in grams:
+            packed.extend(self._postings(gram))
+            offsets.append(len(packed))
+        return {"references": self.references, "slots": self.slots,
+                "grams": grams, "offsets": offsets, "packed": packed}
+
+    def __setstate__(self, state):
+        self.references = state["references"]
+        self.slots = state["slots"]
+        self.postings = {}
+        grams = state["grams"]
+        self._packed_ids = dict(zip(grams, range(len(grams))))
+        self._offsets = state["offsets"]
+        self._packed = state["packed"]
+
+    def lookup(self, text, words=8, limit=5, max_postings=20000):
+        """Return up to limit (reference, score) pairs, best first.
+
+        Only the first words of text are used. Each n-gram counts by its
+        inverse document frequency, less the further it is from where it
+        was heard in the recitation. N-grams in more than max_postings
+        places say little about the verse and are skipped.
+        """
+        keys = _keys(tokenize(text)[:words])
+        total = len(self.slots)
+        scores = collections.defaultdict(float)
+        mask = _MAX_POSITION
+        for query_position, gram in _grams(keys):
+            postings = self._postings(gram)
+            if not postings or len(postings) > max_postings:
+                continue
+            idf = math.log(1 + total / len(postings))
+            for posting in postings:
+                distance = abs((posting & mask) - query_position)
+                scores[posting >> _POSITION_BITS] += idf / (1 + distance / 4)
+        best = heapq.nlargest(limit + len(self.references) - len(self.slots),
+                              scores.items(), key=lambda kv: kv[1])
+        return [(self.references[i], score) for i, score in best
+                if self.references[i] is not None][:limit]
@@ -0,0 +1,136 @@
+import ast
+import collections
+import concurrent.futures
+import hashlib
+import logging
+import re
+
+from . diff import fuzzydiff, tokenize
+from . model import ReviewResult, Transcript
+
+_fuzzydiff_line = re.compile(r":fuzzydiff\((.*)\)$")
+_score_line = re.compile(r":score: (\S+) result: ReviewResult\.(\w+)$")
+# Logged before recitations are graded once they are also stored as
+# transcripts, the log after it would only import them a second time.
+TRANSCRIPTS_STORED = "transcripts are stored from here on"
+
+
+def parse_mem_log(lines, references_by_text):
+    """Yield (uid, transcript) for every graded recitation in mem.log.
+
+    Each `score: ... result: ...` line follows the `fuzzydiff(...)` call
+    that produced it. The log has no dates and no references, so the
+    reference is looked up from the expected text. Parsing stops at the
+    first TRANSCRIPTS_STORED line.
+
+    >>> log = ["INFO:root:fuzzydiff('Jesus wept.', 'jesus wept')",
+    ...        "INFO:root:score: 1.0 result: ReviewResult.EASY",
+    ...        f"INFO:root:{TRANSCRIPTS_STORED}",
+    ...        "INFO:root:fuzzydiff('Jesus wept.', 'jesus slept')",
+    ...        "INFO:root:score: 0.5 result: ReviewResult.FAIL"]
+    >>> [t.text for _, t in parse_mem_log(log, {"Jesus wept.": "John 11:35"})]
+    ['jesus wept']
+    """
+    last_diff = None
+    for lineno, line in enumerate(lines):
+        line = line.rstrip("\n")
+        if line.endswith(f":{TRANSCRIPTS_STORED}"):
+            return
+        m = _fuzzydiff_line.search(line)
+        if m:
+            # Only the call just before a score is parsed.
+            last_diff = m.group(1)
+            continue
+        m = _score_line.search(line)
+        if not m or not last_diff:
+            continue
+        try:
+            expected, text = ast.literal_eval(f"({last_diff})")
+        except (ValueError, SyntaxError):
+            continue
+        finally:
+            last_diff = None
+        reference = references_by_text.get(expected)
+        if reference is None:
+            continue
+        uid = hashlib.sha1(f"mem.log|{lineno}|{expected}|{text}"
+                           .encode("utf-8")).hexdigest()
+        yield uid, Transcript(reference, None, expected, text,
+                              float(m.group(1)), ReviewResult[m.group(2)])
+
+
+# Tokens of every distinct expected text, set up once per worker.
+_expected_tokens = None
+
+
+def _init_worker(expected_tokens):
+    global _expected_tokens
+    # Forked workers inherit the mem.log handler, regrading mustn't log
+    # every diff again.
+    logging.disable(logging.INFO)
+    _expected_tokens = expected_tokens
+
+
+def _score_chunk(chunk):
+    return [(id, fuzzydiff(None, text, _expected_tokens[key]).score())
+            for id, key, text in chunk]
+
+
+def regrade(transcripts, workers=None, chunk_size=500):
+    """Rerun fuzzydiff over (id, transcript) pairs.
+
+    Returns {id: new score}. Each distinct verse is tokenized once in this
+    process and shipped to the workers when they start.
+    """
+    keys = {}
+    expected_tokens = []
+    chunks = []
+    chunk = []
+    for id, t in transcripts:
+        key = keys.get(t.expected)
+        if key is None:
+            key = keys[t.expected] = len(expected_tokens)
+            expected_tokens.append(tokenize(t.expected))
+        chunk.append((id, key, t.text))
+        if len(chunk) == chunk_size:
+            chunks.append(chunk)
+            chunk = []
+    if chunk:
+        chunks.append(chunk)
+
+    scores = {}
+    with concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=_init_worker,
+            initargs=(expected_tokens,)) as pool:
+        for results in pool.map(_score_chunk, chunks):
+            scores.update(results)
+    return scores
+
+
+def print_report(transcripts, scores, rules, limit=10):
+    transitions = collections.Counter()
+    deltas = []
+    for id, t in transcripts.items():
+        new_score = scores[id]
+        deltas.append((new_score - t.score, id))
+        transitions[(t.result, rules.grade(new_score))] += 1
+
+    changed = sum(n for (old, new), n in transitions.items() if old != new)
+    print(f"{len(deltas)} transcripts, {changed} results changed")
+    for (old, new), n in sorted(transitions.items(),
+                                key=lambda kv: (kv[0][0].value,
+                                                kv[0][1].value)):
+        marker = "" if old == new else "  *"
+        print(f"  {old.value:>4} -> {new.value:<4} {n}{marker}")
+    if not deltas:
+        return
+    mean = sum(d for d, _ in deltas) / len(deltas)
+    print(f"score delta: mean {mean:+.4f}, "
+          f"min {min(deltas)[0]:+.4f}, max {max(deltas)[0]:+.4f}")
+    deltas.sort(key=lambda d: -abs(d[0]))
+    print("largest changes:")
+    for delta, id in deltas[:limit]:
+        if not delta:
+            break
+        t = transcripts[id]
+        print(f"  {delta:+.4f} {t.reference}: {t.text[:60]}")
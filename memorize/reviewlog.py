@@ -0,0 +1,362 @@
+import contextlib
+import fcntl
+import hashlib
+import os
+import pickle
+import struct
+
+from . model import (Reference, Review, ReviewPrompAspect,
+                     ReviewResponseAspect, ReviewResult)
+from . schedule import ReviewScore, DEFAULT_RULES
+
+# Enum members are stored by position, so new members may only be appended.
+_prompts = list(ReviewPrompAspect)
+_responses = list(ReviewResponseAspect)
+_results = list(ReviewResult)
+
+# Each record is a little endian length prefix followed by the timestamp,
+# UTC offset, prompt and response bitmasks, result and the reference text.
+_length = struct.Struct("<I")
+_record = struct.Struct("<qiIIB")
+
+SNAPSHOT_INTERVAL = 100
+# Snapshots pickle ReviewScore objects, bump when their attributes change.
+SNAPSHOT_VERSION = 1
+
+
+def _mask(aspects, members):
+    m = 0
+    for a in aspects:
+        m |= 1 << members.index(a)
+    return m
+
+
+def _unmask(m, members):
+    return frozenset(a for i, a in enumerate(members) if m & (1 << i))
+
+
+def encode(review):
+    payload = _record.pack(review.timestamp,
+                           review.utc_offset,
+                           _mask(review.prompt, _prompts),
+                           _mask(review.response, _responses),
+                           _results.index(review.result))
+    payload += str(review.reference).encode("utf-8")
+    return _length.pack(len(payload)) + payload
+
+
+def decode(payload, references=None):
+    """Decode the payload of a record, after its length prefix.
+
+    >>> review = Review(Reference.parse("1 Cor 13:4-7"), 1700000000,
+    ...                 frozenset({ReviewPrompAspect.REFERENCE,
+    ...                            ReviewPrompAspect.FIRST_LETTERS}),
+    ...                 frozenset({ReviewResponseAspect.READ_ALOUD}),
+    ...                 ReviewResult.HARD, -5 * 3600)
+    >>> decode(encode(review)[_length.size:]) == review
+    True
+    """
+    timestamp, utc_offset, prompt, response, result = \
+        _record.unpack_from(payload)
+    text = payload[_record.size:]
+    if references is None:
+        reference = Reference.parse(text.decode("utf-8"))
+    else:
+        reference = references.get(text)
+        if reference is None:
+            reference = Reference.parse(text.decode("utf-8"))
+            references[text] = reference
+    return Review(reference, timestamp,
+                  _unmask(prompt, _prompts),
+                  _unmask(response, _responses),
+                  _results[result],
+                  utc_offset)
+
+
+def _rules_hash():
+    return hashlib.sha1(repr(DEFAULT_RULES).encode("utf-8")).hexdigest()
+
+
+def _read_snapshot(path):
+    """The snapshot at path, None if it is missing or from other code."""
+    try:
+        with open(path, "rb") as f:
+            snapshot = pickle.load(f)
+    except (OSError, EOFError, AttributeError, ImportError,
+            pickle.UnpicklingError):
+        return None
+    if (not isinstance(snapshot, dict)
+            or snapshot.get("version") != SNAPSHOT_VERSION
+            or snapshot.get("rules") != _rules_hash()):
+        return None
+    return snapshot
+
+
+def _extend(scores, review):
+    """Feed review to its score, returning False if it is out of order."""
+    score = scores.get(review.reference)
+    if score is None:
+        scores[review.reference] = ReviewScore(review.reference, [review])
+    elif score.previous_review.timestamp > review.timestamp:
+        return False
+    else:
+        score.extend([review])
+    return True
+
+
+class ReviewLog:
+    """Append-only binary log of reviews.
+
+    The scheduler state derived from the log is snapshotted every
+    SNAPSHOT_INTERVAL appends so that recovering only has to replay the
+    reviews written since the last snapshot. A snapshot written by another
+    version of the scheduler is ignored and the whole log replayed.
+
+    Reviews can be stored in reviews.db without the log, `synced` is the
+    review id up to which they have all been appended, see `catch_up`.
+
+    Several review sessions can append to the same log. Every change is
+    made holding a lock on path + ".lock", and the records appended by the
+    others are replayed before appending.
+    """
+
+    def __init__(self, path="reviews.log"):
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self.scores = None
+        self.end = 0
+        self.appended_since_snapshot = 0
+        self.synced = 0
+        # Where the log ended when it was last synced
+        self.synced_offset = 0
+        self._lock_file = None
+        self._lock_depth = 0
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # Reentrant, flock would block on a second open file of our own.
+        if not self._lock_depth:
+            self._lock_file = open(self.path + ".lock", "ab")
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        self._lock_depth += 1
+        try:
+            yield
+        finally:
+            self._lock_depth -= 1
+            if not self._lock_depth:
+                self._lock_file.close()
+                self._lock_file = None
+
+    @classmethod
+    def create(cls, path, reviews, synced=0):
+        """Write a new log from chronologically ordered reviews.
+
+        `synced` is the last review id of the reviews.db they are from.
+        """
+        log = cls(path)
+        with log._locked():
+            tmp = path + ".tmp"
+            with open(tmp, "wb") as f:
+                for r in reviews:
+                    f.write(encode(r))
+            os.replace(tmp, path)
+            if os.path.exists(log.snapshot_path):
+                os.remove(log.snapshot_path)
+            log.recover()
+            log.synced = synced
+            log.synced_offset = log.end
+            log.snapshot()
+        return log
+
+    def read(self, offset=0):
+        """Yield (end offset, review) for every complete record."""
+        references = {}
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            while True:
+                header = f.read(_length.size)
+                if len(header) < _length.size:
+                    return
+                length, = _length.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length:
+                    # A torn write at the end of the log
+                    return
+                offset += _length.size + length
+                yield offset, decode(payload, references)
+
+    def __iter__(self):
+        for _, review in self.read():
+            yield review
+
+    def recover(self):
+        """Return the scores by reference from the snapshot plus the tail.
+
+        A record torn by a crash while it was appended is cut off.
+
+        >>> import tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), "reviews.log")
+        >>> reviews = [Review(Reference.parse("John 11:35"), t,
+        ...                   frozenset({ReviewPrompAspect.BLIND}),
+        ...                   frozenset({ReviewResponseAspect.READ_ALOUD}),
+        ...                   ReviewResult.EASY) for t in range(3)]
+        >>> log = ReviewLog.create(path, reviews[:1])
+        >>> log.append(reviews[1])
+        >>> end = log.end
+        >>> with open(path, "ab") as f:
+        ...     _ = f.write(encode(reviews[2])[:-4])
+        >>> log = ReviewLog(path)
+        >>> log.recover()[reviews[0].reference].previous_review == reviews[1]
+        True
+        >>> log.end == end == os.path.getsize(path)
+        True
+
+        A snapshot from another version of the scheduler is ignored.
+
+        >>> with open(log.snapshot_path, "wb") as f:
+        ...     pickle.dump({"offset": end, "scores": {}}, f)
+        >>> list(ReviewLog(path).recover()) == [reviews[0].reference]
+        True
+        """
+        with self._locked():
+            snapshot = _read_snapshot(self.snapshot_path)
+            if snapshot and snapshot["offset"] <= self._size():
+                self.scores = snapshot["scores"]
+                self.end = snapshot["offset"]
+                self.synced = snapshot["synced"]
+                self.synced_offset = snapshot["synced_offset"]
+            else:
+                self.scores = {}
+                self.end = self.synced = self.synced_offset = 0
+            self.appended_since_snapshot = 0
+            self._replay()
+        return self.scores
+
+    def _size(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def _replay(self):
+        """Feed the records after `end` to the scores, run with the lock.
+
+        These were appended by other processes, or since the snapshot.
+        """
+        offset = self.end
+        out_of_order = set()
+        for offset, r in self.read(offset):
+            self.appended_since_snapshot += 1
+            if not _extend(self.scores, r):
+                out_of_order.add(r.reference)
+        if self._size() > offset:
+            # Torn by a crash, nobody else is writing while we hold the lock
+            os.truncate(self.path, offset)
+        self.end = offset
+        if out_of_order:
+            self.rescore(out_of_order)
+
+    def rescore(self, references):
+        """Rebuild the scores of references from their full history.
+
+        Needed when reviews were appended out of date order, e.g. by a merge.
+        """
+        reviews = {reference: [] for reference in references}
+        for r in self:
+            if r.reference in reviews:
+                reviews[r.reference].append(r)
+        for reference, history in reviews.items():
+            history.sort(key=lambda r: r.timestamp)
+            self.scores[reference] = ReviewScore(reference, history)
+
+    def append(self, review):
+        self.extend([review])
+
+    def extend(self, reviews):
+        """Append reviews with a single fsync.
+
+        Another session appending to the same log is caught up with first.
+
+        >>> import tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), "reviews.log")
+        >>> a, b = ReviewLog(path), ReviewLog(path)
+        >>> a.recover(), b.recover()
+        ({}, {})
+        >>> for log, reference in [(b, "John 1:2"), (a, "John 1:1")]:
+        ...     log.append(Review(Reference.parse(reference), 0,
+        ...                       frozenset({ReviewPrompAspect.BLIND}),
+        ...                       frozenset({ReviewResponseAspect.READ_ALOUD}),
+        ...                       ReviewResult.EASY))
+        >>> a.snapshot()
+        >>> sorted(str(r) for r in ReviewLog(path).recover())
+        ['John 1:1', 'John 1:2']
+        """
+        with self._locked():
+            if self.scores is None:
+                self.recover()
+            else:
+                self._replay()
+            with open(self.path, "ab") as f:
+                for r in reviews:
+                    f.write(encode(r))
+                f.flush()
+                os.fsync(f.fileno())
+                self.end = f.tell()
+            out_of_order = set()
+            for r in reviews:
+                if not _extend(self.scores, r):
+                    out_of_order.add(r.reference)
+                self.appended_since_snapshot += 1
+            if out_of_order:
+                self.rescore(out_of_order)
+            if self.appended_since_snapshot >= SNAPSHOT_INTERVAL:
+                self.snapshot()
+
+    def catch_up(self, reviews, position):
+        """Append the reviews stored in reviews.db without the log.
+
+        `reviews` are those stored after review id `synced`, up to
+        `position`. The ones appended to the log since it was last synced
+        are skipped. Returns how many reviews were appended.
+
+        >>> import tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), "reviews.log")
+        >>> reviews = [Review(Reference.parse("John 11:35"), t,
+        ...                   frozenset({ReviewPrompAspect.BLIND}),
+        ...                   frozenset({ReviewResponseAspect.READ_ALOUD}),
+        ...                   ReviewResult.EASY) for t in range(3)]
+        >>> log = ReviewLog.create(path, reviews[:1], synced=1)
+        >>> log.append(reviews[1])
+        >>> log.catch_up(reviews[1:], 3)
+        1
+        >>> log.catch_up([], 3)
+        0
+        >>> [r.timestamp for r in ReviewLog(path)]
+        [0, 1, 2]
+        >>> log.synced, log.synced_offset == log.end
+        (3, True)
+        """
+        with self._locked():
+            if self.scores is None:
+                self.recover()
+            logged = {r.uid for _, r in self.read(self.synced_offset)}
+            missing = [r for r in reviews if r.uid not in logged]
+            if missing:
+                self.extend(missing)
+            if missing or position != self.synced:
+                self.synced = position
+                self.synced_offset = self.end
+                self.snapshot()
+        return len(missing)
+
+    def snapshot(self):
+        with self._locked():
+            tmp = self.snapshot_path + ".tmp"
+            with open(tmp, "wb") as f:
+                pickle.dump({"version": SNAPSHOT_VERSION,
+                             "rules": _rules_hash(),
+                             "offset": self.end, "scores": self.scores,
+                             "synced": self.synced,
+                             "synced_offset": self.synced_offset}, f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.snapshot_path)
+        self.appended_since_snapshot = 0
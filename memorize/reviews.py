@@ -1,178 +1,119 @@
-import attr
-import cattr
-import cattr.preconf.json
-import re
+import contextlib
+import functools
+import time
 import os.path
 import yaml
-import enum
+import json
+import hashlib
+import itertools
+import uuid
 import pendulum
-from typing import FrozenSet
 import peewee
+from playhouse.migrate import SqliteMigrator, migrate
+from playhouse.pool import PooledSqliteDatabase
+from playhouse.shortcuts import ThreadSafeDatabaseMetadata
 
+from . model import (Reference, ReviewPrompAspect, text_prompt_levels,
+                     deprecated_text_prompts, step_down_difficulty,
+                     step_up_difficulty, ReviewResponseAspect, ReviewResult,
+                     Review, Transcript, converter)
+from . schedule import ReviewScore
+from . catalog import Catalog
 
-@attr.frozen(order=True)
-class Reference:
-    book: str
-    chapter: int
-    verse: int
-    verse_end: int
 
-    @classmethod
-    def parse(cls, s):
-        m = re.match(r"(\d?\s?\w+)\s+(\d+):(\d+)-(\d+)", s)
-        if m:
-            book, chapter, verse, verse_end = m.groups()
-            return Reference(book, int(chapter), int(verse), int(verse_end))
-        else:
-            m = re.match(r"(\d?\s?\w+)\s+(\d+):(\d+)", s)
-            book, chapter, verse = m.groups()
-            return Reference(book, int(chapter), int(verse), int(verse))
-
-    def __str__(self):
-        if self.verse != self.verse_end:
-            return f"{self.book} {self.chapter}:{self.verse}-{self.verse_end}"
-        else:
-            return f"{self.book} {self.chapter}:{self.verse}"
-
-    def verse_count(self):
-        return self.verse_end - self.verse + 1
-
-
-verses = dict((Reference.parse(k), v) for k, v in yaml.load(
-    open("verses.yaml"), Loader=yaml.SafeLoader).items())
+catalog = Catalog.load("verses.yaml")
+verses = catalog.verses
 
 verse_count = sum(r.verse_count() for r in verses)
 print(f"Loaded {verse_count} verses")
 
 
-@enum.unique
-class ReviewPrompAspect(enum.Enum):
-    REFERENCE = "reference"
-    IMAGE = "image"
-    FULL_TEXT = "full-text"
-    MIDDLE_UNDERSCORE = "middle-underscore"
-    ENDING_UNDERSCORE = "ending-underscore"
-    FIRST_LETTERS = "first-letters"
-    FIRST_LETTERS_1 = "first-letters-1"
-    FIRST_LETTERS_2 = "first-letters-2"
-    FIRST_LETTERS_3 = "first-letters-3"
-    FIRST_LETTERS_4 = "first-letters-4"
-    FIRST_LETTERS_5 = "first-letters-5"
-    FIRST_WORD = "first-word"
-    BLIND = "blind"
-
-
-text_prompt_levels = [
-    ReviewPrompAspect.FULL_TEXT,
-    ReviewPrompAspect.ENDING_UNDERSCORE,
-    ReviewPrompAspect.FIRST_LETTERS,
-    ReviewPrompAspect.FIRST_LETTERS_1,
-    ReviewPrompAspect.FIRST_LETTERS_2,
-    ReviewPrompAspect.FIRST_LETTERS_3,
-    ReviewPrompAspect.FIRST_LETTERS_4,
-    ReviewPrompAspect.FIRST_LETTERS_5,
-    ReviewPrompAspect.FIRST_WORD,
-    ReviewPrompAspect.BLIND,
-]
-
-deprecated_text_prompts = {}
-
-
-def step_down_difficulty(aspects):
-    new_aspects = set()
-    non_text_prompt_aspects = set()
-    text_level_found = False
-    for a in aspects:
-        if a in text_prompt_levels:
-            text_level_found = True
-            index = text_prompt_levels.index(a)
-            index -= 1
-            if index < 0:
-                index = 0
-            # Assumes that the min is not deprecated
-            while text_prompt_levels[index] in deprecated_text_prompts:
-                index -= 1
-            new_aspects.add(text_prompt_levels[index])
-        else:
-            non_text_prompt_aspects.add(a)
-    if not text_level_found:
-        new_aspects.add(text_prompt_levels[0])
-    new_aspects.update(non_text_prompt_aspects)
-    return new_aspects
-
-
-def step_up_difficulty(aspects):
-    new_aspects = set()
-    # First, find the text prompt
-    text_level_maxed = False
-    text_level_found = False
-    non_text_prompt_aspects = set()
-    for a in aspects:
-        if a in text_prompt_levels:
-            text_level_found = True
-            index = text_prompt_levels.index(a)
-            index += 1
-            if index >= len(text_prompt_levels):
-                index = len(text_prompt_levels) - 1
-                text_level_maxed = True
-            # Assumes that that the max is not depricated
-            while text_prompt_levels[index] in deprecated_text_prompts:
-                index += 1
-            new_aspects.add(text_prompt_levels[index])
-        else:
-            non_text_prompt_aspects.add(a)
-    if not text_level_found:
-        new_aspects.add(text_prompt_levels[0])
-    new_aspects.add(ReviewPrompAspect.REFERENCE)
-    new_aspects.update(non_text_prompt_aspects)
-    if text_level_maxed:
-        new_aspects.discard(ReviewPrompAspect.IMAGE)
-    return new_aspects
-
-
-@enum.unique
-class ReviewResponseAspect(enum.Enum):
-    READ_ALOUD = "read-aloud"
-
-
-@enum.unique
-class ReviewResult(enum.Enum):
-    FAIL = "fail"
-    HARD = "hard"
-    EASY = "easy"
-
-
-@attr.frozen(order=True)
-class Review:
-    reference: Reference
-    date: pendulum.DateTime
-    prompt: FrozenSet[ReviewPrompAspect]
-    response: FrozenSet[ReviewResponseAspect]
-    result: ReviewResult
-
-
-converter = cattr.preconf.json.make_converter()
-converter.register_structure_hook(
-    Reference, lambda s, _: Reference.parse(s))
-converter.register_unstructure_hook(Reference, lambda r: str(r))
-
-
 def load_yaml():
     if not os.path.exists("reviews.yaml"):
         return []
     reviews_yaml = yaml.load(open("reviews.yaml"), Loader=yaml.SafeLoader)
     if reviews_yaml:
         reviews = converter.structure(reviews_yaml, list[Review])
-        reviews.sort(key=lambda r: r.date)
+        reviews.sort(key=lambda r: r.timestamp)
     else:
         reviews = []
     return reviews
 
 
-yaml_reviews = load_yaml()
+
+DATABASE = "reviews.db"
+# Seconds to wait for another process to release its lock.
+BUSY_TIMEOUT = 10
+LOCKED_RETRIES = 5
+
+
+def open_database(path, read_only=False, max_connections=8):
+    """Open a pooled connection to a reviews database.
+
+    The database is put in WAL mode so that readers in other processes never
+    block the review loop. A read-only database opens the file with
+    mode=ro, which is meant for stats and other analytics.
+    """
+    pragmas = {"busy_timeout": BUSY_TIMEOUT * 1000}
+    # The pool hands a connection to one thread at a time, but not always
+    # to the thread that opened it.
+    if read_only:
+        return PooledSqliteDatabase(f"file:{path}?mode=ro", uri=True,
+                                    max_connections=max_connections,
+                                    pragmas=pragmas,
+                                    check_same_thread=False)
+    pragmas.update({"journal_mode": "wal", "synchronous": "normal"})
+    return PooledSqliteDatabase(path, max_connections=max_connections,
+                                pragmas=pragmas, check_same_thread=False)
 
 
-db = peewee.SqliteDatabase("reviews.db")
+def retry_locked(f):
+    """Retry f when SQLite still reports the database as locked."""
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        for attempt in range(LOCKED_RETRIES):
+            try:
+                return f(*args, **kwargs)
+            except peewee.OperationalError as e:
+                if "locked" not in str(e) or attempt == LOCKED_RETRIES - 1:
+                    raise
+                time.sleep(0.05 * 2 ** attempt)
+    return wrapper
+
+
+db = open_database(DATABASE)
+read_only_db = open_database(DATABASE, read_only=True)
+
+
+@contextlib.contextmanager
+def connection(read_only=False):
+    """Hold a pooled connection for this thread for the duration of the block.
+
+    Models are always bound to `db`. Queries for a read-only connection are
+    run with `database.execute(query)` on the yielded database.
+    """
+    database = read_only_db if read_only else db
+    opened = database.connect(reuse_if_open=True)
+    try:
+        yield database
+    finally:
+        if opened:
+            database.close()
+
+
+class ThreadLocalMetadata(ThreadSafeDatabaseMetadata):
+    """Model metadata whose database is bound per thread.
+
+    bind_ctx then only rebinds the models in the calling thread, the server
+    binds them to a user's database in its worker threads. Unlike peewee's
+    the schema manager is left to follow the binding of the thread, rather
+    than get the database last bound in any thread.
+    """
+
+    def set_database(self, database):
+        with self._lock:
+            self.database = database
+            del self.table
 
 
 class ReferenceModel(peewee.Model):
@@ -180,9 +121,18 @@ class ReferenceModel(peewee.Model):
     chapter = peewee.IntegerField()
     verse = peewee.IntegerField()
     verse_end = peewee.IntegerField()
+    # When the text of the verse was last edited, earlier reviews were of
+    # the old text and are left out of scheduling.
+    text_changed = peewee.IntegerField(null=True)
+    # Hash of the text the verse is scheduled with, see flag_edited_verses.
+    text_hash = peewee.CharField(null=True)
 
     class Meta:
         database = db
+        model_metadata_class = ThreadLocalMetadata
+        indexes = (
+            (("book", "chapter", "verse", "verse_end"), False),
+        )
 
     def to_reference(self):
         return Reference(self.book, self.chapter, self.verse, self.verse_end)
@@ -190,66 +140,561 @@ class ReferenceModel(peewee.Model):
 
 class ReviewModel(peewee.Model):
     reference = peewee.ForeignKeyField(ReferenceModel, backref="reviews")
-    date = peewee.DateTimeField()
+    uid = peewee.CharField(unique=True)
+    timestamp = peewee.IntegerField(index=True)
+    utc_offset = peewee.IntegerField(default=0)
     prompt = peewee.CharField()
     response = peewee.CharField()
     result = peewee.CharField()
 
     class Meta:
         database = db
+        model_metadata_class = ThreadLocalMetadata
+        indexes = (
+            (("reference", "timestamp"), False),
+            # Cover the aggregates in stats.py
+            (("reference", "result"), False),
+            (("prompt", "result"), False),
+        )
 
     def to_review(self):
         return Review(self.reference.to_reference(),
-                      pendulum.parse(self.date),
+                      self.timestamp,
                       frozenset(ReviewPrompAspect(s)
                                 for s in self.prompt.split(",")),
                       frozenset(ReviewResponseAspect(s)
                                 for s in self.response.split(",")),
-                      ReviewResult(self.result))
+                      ReviewResult(self.result),
+                      self.utc_offset)
+
 
+class DeviceModel(peewee.Model):
+    """A database this one has been merged with, or itself if `is_local`."""
+    device_id = peewee.CharField(unique=True)
+    is_local = peewee.BooleanField(default=False)
+    # Highest review id of the device that has been merged into this
+    # database, and highest local review id that has been sent to it.
+    pulled = peewee.IntegerField(default=0)
+    pushed = peewee.IntegerField(default=0)
 
-db.connect()
-db.create_tables([ReferenceModel, ReviewModel])
+    class Meta:
+        database = db
+        model_metadata_class = ThreadLocalMetadata
+
+
+class ScheduleModel(peewee.Model):
+    """The persisted result of scoring a reference."""
+    reference = peewee.ForeignKeyField(ReferenceModel, unique=True)
+    due = peewee.IntegerField(index=True)
+    frequency = peewee.FloatField()
+    bucket = peewee.IntegerField()
+    purgatory_countdown = peewee.IntegerField()
+    last_review = peewee.IntegerField(null=True)
+
+    class Meta:
+        database = db
+        model_metadata_class = ThreadLocalMetadata
+
+
+class TranscriptModel(peewee.Model):
+    review = peewee.ForeignKeyField(ReviewModel, null=True,
+                                    backref="transcripts")
+    reference = peewee.ForeignKeyField(ReferenceModel)
+    uid = peewee.CharField(unique=True)
+    timestamp = peewee.IntegerField(null=True, index=True)
+    expected = peewee.TextField()
+    text = peewee.TextField()
+    score = peewee.FloatField()
+    result = peewee.CharField()
+
+    class Meta:
+        database = db
+        model_metadata_class = ThreadLocalMetadata
+
+    def to_transcript(self):
+        return Transcript(self.reference.to_reference(), self.timestamp,
+                          self.expected, self.text, self.score,
+                          ReviewResult(self.result))
+
+
+MODELS = [ReferenceModel, ReviewModel, DeviceModel, ScheduleModel,
+          TranscriptModel]
+
+
+def migrate_epoch_timestamps(database):
+    """Replace the text `date` column with `timestamp` and `utc_offset`."""
+    if not ReviewModel.table_exists():
+        return
+    table = ReviewModel._meta.table_name
+    columns = {c.name for c in database.get_columns(table)}
+    if "date" not in columns:
+        return
+    print("migrating reviews to epoch timestamps")
+    migrator = SqliteMigrator(database)
+    with database.atomic("IMMEDIATE"):
+        migrate(
+            migrator.add_column(table, "timestamp",
+                                peewee.IntegerField(default=0)),
+            migrator.add_column(table, "utc_offset",
+                                peewee.IntegerField(default=0)))
+        rows = database.execute_sql(f"SELECT id, date FROM {table}").fetchall()
+        updates = []
+        for id, date in rows:
+            d = pendulum.parse(str(date))
+            updates.append((d.int_timestamp, d.offset, id))
+        database.cursor().executemany(
+            f"UPDATE {table} SET timestamp = ?, utc_offset = ? WHERE id = ?",
+            updates)
+        migrate(migrator.drop_column(table, "date"))
+
+
+def migrate_review_uids(database):
+    """Add the `uid` column, dropping the reviews found to be duplicates."""
+    if not ReviewModel.table_exists():
+        return
+    table = ReviewModel._meta.table_name
+    columns = {c.name for c in database.get_columns(table)}
+    if "uid" in columns:
+        return
+    print("adding review uids")
+    migrator = SqliteMigrator(database)
+    with database.atomic("IMMEDIATE"):
+        migrate(migrator.add_column(table, "uid",
+                                    peewee.CharField(null=True)))
+        query = _review_query(ReviewModel.id).order_by(ReviewModel.id)
+        rows = list(database.execute(query))
+        updates = []
+        duplicates = []
+        seen = set()
+        for row, review in zip(rows, _decode_rows(r[1:] for r in rows)):
+            if review.uid in seen:
+                duplicates.append((row[0],))
+            else:
+                seen.add(review.uid)
+                updates.append((review.uid, row[0]))
+        cursor = database.cursor()
+        cursor.executemany(f"UPDATE {table} SET uid = ? WHERE id = ?",
+                           updates)
+        cursor.executemany(f"DELETE FROM {table} WHERE id = ?", duplicates)
+
+
+def migrate_reference_text_changed(database):
+    """Add the `text_changed` column to references."""
+    if not ReferenceModel.table_exists():
+        return
+    table = ReferenceModel._meta.table_name
+    columns = {c.name for c in database.get_columns(table)}
+    if "text_changed" in columns:
+        return
+    print("adding reference text_changed")
+    migrator = SqliteMigrator(database)
+    with database.atomic("IMMEDIATE"):
+        migrate(migrator.add_column(table, "text_changed",
+                                    peewee.IntegerField(null=True)))
+
+
+def migrate_reference_text_hash(database):
+    """Add the `text_hash` column to references."""
+    if not ReferenceModel.table_exists():
+        return
+    table = ReferenceModel._meta.table_name
+    columns = {c.name for c in database.get_columns(table)}
+    if "text_hash" in columns:
+        return
+    print("adding reference text_hash")
+    migrator = SqliteMigrator(database)
+    with database.atomic("IMMEDIATE"):
+        migrate(migrator.add_column(table, "text_hash",
+                                    peewee.CharField(null=True)))
+
+
+def setup_database(database):
+    """Migrate and create the tables of the database MODELS are bound to."""
+    database.connect(reuse_if_open=True)
+    migrate_epoch_timestamps(database)
+    migrate_review_uids(database)
+    migrate_reference_text_changed(database)
+    migrate_reference_text_hash(database)
+    database.create_tables(MODELS)
+
+
+def local_device_id():
+    device, _ = DeviceModel.get_or_create(
+        is_local=True, defaults={"device_id": uuid.uuid4().hex})
+    return device.device_id
+
+
+def _review_query(*extra):
+    return (ReviewModel
+            .select(*extra, ReferenceModel.id, ReferenceModel.book,
+                    ReferenceModel.chapter, ReferenceModel.verse,
+                    ReferenceModel.verse_end, ReviewModel.timestamp,
+                    ReviewModel.prompt, ReviewModel.response,
+                    ReviewModel.result, ReviewModel.utc_offset)
+            .join(ReferenceModel))
+
+
+def _decode_rows(rows):
+    # Rows are read as plain tuples and the few distinct references and
+    # prompt strings are only parsed once.
+    references = {}
+    prompts = {}
+    responses = {}
+    for (reference_id, book, chapter, verse, verse_end, timestamp,
+         prompt_s, response_s, result, utc_offset) in rows:
+        reference = references.get(reference_id)
+        if reference is None:
+            reference = Reference(book, chapter, verse, verse_end)
+            references[reference_id] = reference
+        prompt = prompts.get(prompt_s)
+        if prompt is None:
+            prompt = frozenset(ReviewPrompAspect(s)
+                               for s in prompt_s.split(","))
+            prompts[prompt_s] = prompt
+        response = responses.get(response_s)
+        if response is None:
+            response = frozenset(ReviewResponseAspect(s)
+                                 for s in response_s.split(","))
+            responses[response_s] = response
+        yield Review(reference, timestamp, prompt, response,
+                     ReviewResult(result), utc_offset)
+
+
+def _execute(query):
+    # Go through the model so that databases bound with bind_ctx are used.
+    return ReviewModel._meta.database.execute(query)
 
 
 def load_sqlite():
-    for m in ReviewModel.select():
-        yield m.to_review()
+    """Stream every review in date order."""
+    query = _review_query().order_by(ReviewModel.timestamp)
+    return _decode_rows(_execute(query))
 
 
-def save_review_sqlite(r):
-    reference, created = ReferenceModel.get_or_create(
-        book=r.reference.book,
-        chapter=r.reference.chapter,
-        verse=r.reference.verse,
-        verse_end=r.reference.verse_end)
-    m = ReviewModel.create(
-        reference=reference,
-        date=str(r.date),
-        prompt=",".join(e.value for e in r.prompt),
-        response=",".join(e.value for e in r.response),
-        result=r.result.value)
-    m.save()
+def reviews_after(id):
+    """Stream the reviews stored after review `id`, in storage order."""
+    query = (_review_query()
+             .where(ReviewModel.id > id)
+             .order_by(ReviewModel.id))
+    return _decode_rows(_execute(query))
+
+
+def last_review_id():
+    return ReviewModel.select(peewee.fn.MAX(ReviewModel.id)).scalar() or 0
+
 
+def _since_text_changed():
+    return (ReferenceModel.text_changed.is_null()
+            | (ReviewModel.timestamp >= ReferenceModel.text_changed))
 
-sqlite_reviews = set(load_sqlite())
 
-for r in yaml_reviews:
-    if r not in sqlite_reviews:
-        print("saving to sqlite")
-        save_review_sqlite(r)
-        sqlite_reviews.add(r)
+def reviews_for_reference(reference):
+    """Stream the reviews of the current text of reference in date order."""
+    query = (_review_query()
+             .where(_since_text_changed(),
+                    ReferenceModel.book == reference.book,
+                    ReferenceModel.chapter == reference.chapter,
+                    ReferenceModel.verse == reference.verse,
+                    ReferenceModel.verse_end == reference.verse_end)
+             .order_by(ReviewModel.timestamp))
+    return _decode_rows(_execute(query))
 
-all_reviews = list(sqlite_reviews)
-all_reviews.sort(key=lambda r: r.date)
+
+def iter_reviews_by_reference():
+    """Yield (reference, reviews) pairs, the reviews in date order.
+
+    Reviews of an earlier text of the verse are left out. Rows are streamed
+    off the (reference, timestamp) index, so only the current group is
+    alive at a time. Each group must be consumed before moving on to the
+    next one.
+    """
+    query = (_review_query()
+             .where(_since_text_changed())
+             .order_by(ReviewModel.reference, ReviewModel.timestamp))
+    return itertools.groupby(_decode_rows(_execute(query)),
+                             key=lambda r: r.reference)
+
+
+@retry_locked
+def save_review_sqlite(r):
+    """Store a review, returning False if it is already stored."""
+    database = ReviewModel._meta.database
+    # Take the write lock up front so that two processes can't both create
+    # the same reference.
+    with database.atomic("IMMEDIATE"):
+        reference, created = ReferenceModel.get_or_create(
+            book=r.reference.book,
+            chapter=r.reference.chapter,
+            verse=r.reference.verse,
+            verse_end=r.reference.verse_end,
+            defaults={"text_hash": catalog.hashes.get(r.reference)})
+        try:
+            with database.atomic():
+                ReviewModel.create(
+                    reference=reference,
+                    uid=r.uid,
+                    timestamp=r.timestamp,
+                    utc_offset=r.utc_offset,
+                    prompt=",".join(e.value for e in r.prompt),
+                    response=",".join(e.value for e in r.response),
+                    result=r.result.value)
+        except peewee.IntegrityError:
+            return False
+    return True
+
+
+@retry_locked
+def save_transcript(t, review=None, uid=None):
+    """Store a transcript, returning False if it is already stored.
+
+    `uid` defaults to a hash of the transcript's reference, date and text.
+    """
+    if uid is None:
+        uid = hashlib.sha1(f"{t.reference}|{t.timestamp}|{t.text}"
+                           .encode("utf-8")).hexdigest()
+    with TranscriptModel._meta.database.atomic("IMMEDIATE"):
+        reference, created = ReferenceModel.get_or_create(
+            book=t.reference.book,
+            chapter=t.reference.chapter,
+            verse=t.reference.verse,
+            verse_end=t.reference.verse_end,
+            defaults={"text_hash": catalog.hashes.get(t.reference)})
+        if review is not None:
+            review = ReviewModel.get_or_none(ReviewModel.uid == review.uid)
+        try:
+            with TranscriptModel._meta.database.atomic():
+                TranscriptModel.create(
+                    review=review,
+                    reference=reference,
+                    uid=uid,
+                    timestamp=t.timestamp,
+                    expected=t.expected,
+                    text=t.text,
+                    score=t.score,
+                    result=t.result.value)
+        except peewee.IntegrityError:
+            return False
+    return True
+
+
+@retry_locked
+def save_transcripts(transcripts):
+    """Store (uid, transcript) pairs in bulk, returning how many were new."""
+    with TranscriptModel._meta.database.atomic("IMMEDIATE"):
+        reference_ids = {r.to_reference(): r.id
+                         for r in ReferenceModel.select()}
+        before = TranscriptModel.select().count()
+        rows = []
+        for uid, t in transcripts:
+            reference_id = reference_ids.get(t.reference)
+            if reference_id is None:
+                reference_id = reference_ids[t.reference] = \
+                    ReferenceModel.create(
+                        book=t.reference.book,
+                        chapter=t.reference.chapter,
+                        verse=t.reference.verse,
+                        verse_end=t.reference.verse_end,
+                        text_hash=catalog.hashes.get(t.reference)).id
+            rows.append((reference_id, uid, t.timestamp, t.expected, t.text,
+                         t.score, t.result.value))
+        fields = [TranscriptModel.reference, TranscriptModel.uid,
+                  TranscriptModel.timestamp, TranscriptModel.expected,
+                  TranscriptModel.text, TranscriptModel.score,
+                  TranscriptModel.result]
+        for batch in peewee.chunked(rows, 100):
+            TranscriptModel.insert_many(batch, fields=fields) \
+                .on_conflict_ignore().execute()
+        return TranscriptModel.select().count() - before
+
+
+def load_transcripts():
+    """Stream (id, transcript) for every stored transcript."""
+    query = (TranscriptModel
+             .select(TranscriptModel.id, ReferenceModel.book,
+                     ReferenceModel.chapter, ReferenceModel.verse,
+                     ReferenceModel.verse_end, TranscriptModel.timestamp,
+                     TranscriptModel.expected, TranscriptModel.text,
+                     TranscriptModel.score, TranscriptModel.result)
+             .join(ReferenceModel)
+             .order_by(TranscriptModel.id))
+    references = {}
+    for (id, book, chapter, verse, verse_end, timestamp, expected, text,
+         score, result) in TranscriptModel._meta.database.execute(query):
+        key = (book, chapter, verse, verse_end)
+        reference = references.get(key)
+        if reference is None:
+            reference = references[key] = Reference(*key)
+        yield id, Transcript(reference, timestamp, expected, text, score,
+                             ReviewResult(result))
+
+
+def _reference_ids(references):
+    """{reference: ReferenceModel id} for those of references stored."""
+    key = peewee.Tuple(ReferenceModel.book, ReferenceModel.chapter,
+                       ReferenceModel.verse, ReferenceModel.verse_end)
+    references = [(r.book, r.chapter, r.verse, r.verse_end)
+                  for r in references]
+    ids = {}
+    # Stay well below SQLite's limit on bound parameters
+    for i in range(0, len(references), 500):
+        query = (ReferenceModel
+                 .select(ReferenceModel.id, ReferenceModel.book,
+                         ReferenceModel.chapter, ReferenceModel.verse,
+                         ReferenceModel.verse_end)
+                 .where(key.in_(references[i:i+500]))
+                 .tuples())
+        for id, *row in _execute(query):
+            ids[Reference(*row)] = id
+    return ids
+
+
+@retry_locked
+def save_schedule(scores):
+    scores = list(scores)
+    reference_ids = _reference_ids(s.reference for s in scores)
+    rows = []
+    for s in scores:
+        if s.reference not in reference_ids:
+            # Never reviewed
+            continue
+        rows.append({
+            "reference": reference_ids[s.reference],
+            "due": int(s.due_date),
+            "frequency": s.frequency,
+            "bucket": s.review_bucket,
+            "purgatory_countdown": s.purgatory_countdown,
+            "last_review": (s.previous_review.timestamp
+                            if s.previous_review else None),
+        })
+    with ScheduleModel._meta.database.atomic("IMMEDIATE"):
+        for i in range(0, len(rows), 100):
+            ScheduleModel.insert_many(rows[i:i+100]).on_conflict_replace() \
+                .execute()
+
+
+def update_schedule(references):
+    """Rescore references from their stored history and persist them."""
+    scores = [ReviewScore(reference, reviews_for_reference(reference))
+              for reference in references]
+    save_schedule(scores)
+    return scores
+
+
+def unscheduled_references():
+    """References with reviews but no persisted schedule."""
+    query = (ReferenceModel
+             .select(ReferenceModel.book, ReferenceModel.chapter,
+                     ReferenceModel.verse, ReferenceModel.verse_end)
+             .join(ScheduleModel, peewee.JOIN.LEFT_OUTER)
+             .where(ScheduleModel.id.is_null(),
+                    ReferenceModel.id.in_(
+                        ReviewModel.select(ReviewModel.reference)))
+             .tuples())
+    return {Reference(*row) for row in _execute(query)}
+
+
+def text_changed_references():
+    query = (ReferenceModel
+             .select(ReferenceModel.book, ReferenceModel.chapter,
+                     ReferenceModel.verse, ReferenceModel.verse_end)
+             .where(ReferenceModel.text_changed.is_null(False))
+             .tuples())
+    return {Reference(*row) for row in _execute(query)}
+
+
+def flag_changed_verses(references, now=None):
+    """Restart the schedule of verses whose text was edited."""
+    now = int(time.time()) if now is None else now
+    with ReferenceModel._meta.database.atomic("IMMEDIATE"):
+        for r in references:
+            print(f"{r} changed, its schedule starts over")
+            ReferenceModel.update(text_changed=now).where(
+                ReferenceModel.book == r.book,
+                ReferenceModel.chapter == r.chapter,
+                ReferenceModel.verse == r.verse,
+                ReferenceModel.verse_end == r.verse_end).execute()
+    update_schedule(references)
+
+
+def flag_edited_verses(hashes, edited=(), now=None):
+    """Restart the schedule of verses edited since this database saw them.
+
+    `hashes` are the text hashes of the catalog. A reference without a
+    stored hash is taken to be of the current text, unless it is in
+    `edited`. Returns the references flagged.
+    """
+    query = (ReferenceModel
+             .select(ReferenceModel.id, ReferenceModel.book,
+                     ReferenceModel.chapter, ReferenceModel.verse,
+                     ReferenceModel.verse_end, ReferenceModel.text_hash)
+             .tuples())
+    updates = []
+    changed = []
+    for id, book, chapter, verse, verse_end, text_hash in _execute(query):
+        reference = Reference(book, chapter, verse, verse_end)
+        h = hashes.get(reference)
+        if h is None or h == text_hash:
+            continue
+        updates.append((h, id))
+        if text_hash is not None or reference in edited:
+            changed.append(reference)
+    if changed:
+        flag_changed_verses(changed, now)
+    if updates:
+        database = ReferenceModel._meta.database
+        with database.atomic("IMMEDIATE"):
+            database.cursor().executemany(
+                f"UPDATE {ReferenceModel._meta.table_name} "
+                "SET text_hash = ? WHERE id = ?", updates)
+    return changed
+
+
+def import_yaml():
+    for r in load_yaml():
+        if save_review_sqlite(r):
+            print("saved to sqlite")
+
+
+def setup_local_database():
+    """Get the reviews.db of the working directory ready for the app.
+
+    Migrates it, restarts the schedule of verses edited since the last run
+    and imports reviews.yaml. Importing this module doesn't touch the
+    database, the server keeps one per user instead.
+    """
+    setup_database(db)
+    # Databases from before text_hash only know of edits by the manifest.
+    flag_edited_verses(catalog.hashes, catalog.changed)
+    catalog.save()
+    import_yaml()
+
+
+def export_yaml(reviews, f):
+    """Write reviews as a YAML list one item at a time."""
+    empty = True
+    for r in reviews:
+        yaml.dump([converter.unstructure(r)], f)
+        empty = False
+    if empty:
+        f.write("[]\n")
+
+
+def export_json(reviews, f):
+    """Write reviews as a JSON list one item at a time."""
+    f.write("[")
+    separator = "\n"
+    for r in reviews:
+        f.write(separator)
+        json.dump(converter.unstructure(r), f)
+        separator = ",\n"
+    f.write("\n]\n")
 
 
 def save():
     with open("reviews.yaml", "wt") as f:
-        yaml.dump(converter.unstructure(all_reviews), f)
+        export_yaml(load_sqlite(), f)
 
 
 def save_review(r):
     save_review_sqlite(r)
-    all_reviews.append(r)
     # save()
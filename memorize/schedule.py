@@ -0,0 +1,181 @@
+import attr
+import time
+import pendulum
+
+from . model import ReviewPrompAspect, Reference, ReviewResult
+
+# Scheduling works on plain epoch seconds, pendulum objects are only built
+# when something needs to be displayed.
+HOUR = 60 * 60
+DAY = 24 * HOUR
+WEEK = 7 * DAY
+
+_debug_reference = Reference("Rom", 8, 13, 13)
+
+
+@attr.frozen
+class SpacingRules:
+    """The hand picked constants of the scheduler and of grading.
+
+    Durations are in seconds. See `memorize.simulate` for trying out others.
+    """
+    min_frequency: float = 6 * HOUR
+    fails_before_purgatory: int = 2
+    purgatory_length: int = 5
+    purgatory_frequency: float = 6 * HOUR
+    # Penalties only scale the frequency once it is above decay_threshold.
+    decay_threshold: float = DAY
+    fail_step: float = 6 * HOUR
+    fail_factor: float = .3
+    hard_step: float = 4 * HOUR
+    hard_factor: float = .7
+    # Easy reviews closer together than this don't grow the frequency.
+    easy_repeat_window: float = 4 * HOUR
+    blind_step: float = 24 * HOUR
+    blind_growth: float = 1.32
+    first_word_step: float = 12 * HOUR
+    hinted_frequency: float = 6 * HOUR
+    retry_delay: float = 2 * HOUR
+    bucket_thresholds: tuple = (3 * DAY, WEEK, 3 * WEEK)
+    easy_cutoff: float = .96
+    hard_cutoff: float = .92
+
+    def grade(self, score):
+        if score > self.easy_cutoff:
+            return ReviewResult.EASY
+        elif score > self.hard_cutoff:
+            return ReviewResult.HARD
+        return ReviewResult.FAIL
+
+
+DEFAULT_RULES = SpacingRules()
+
+
+class ReviewScore:
+    """Scheduler state for one reference.
+
+    `reviews` must already be in date order, as returned by
+    `iter_reviews_by_reference`.
+    """
+
+    def __init__(self, reference, reviews, now=None, rules=DEFAULT_RULES):
+        self.rules = rules
+        self.reference = reference
+        self.score = 1
+        self.review_bucket = 0
+        self.frequency = 0
+        self.last_easy = None
+        self.last_hard_or_failed = None
+        self.fails_in_a_row = 0
+        self.previous_easy = None
+        self.purgatory_countdown = 0
+        self.prompt = None
+        self.previous_review = None
+        self.extend(reviews)
+        self.finalize(now)
+
+    def extend(self, reviews):
+        """Feed reviews that are newer than everything fed so far."""
+        for r in reviews:
+            self.feed(r, self.previous_review)
+            self.previous_review = r
+            if self.reference == _debug_reference:
+                print(r.result, self.frequency_duration(), self.prompt)
+
+    def frequency_duration(self):
+        return pendulum.Duration(seconds=self.frequency)
+
+    def feed(self, review, previous_review):
+        rules = self.rules
+        if review.result == ReviewResult.FAIL:
+            self.fails_in_a_row += 1
+            if self.purgatory_countdown:
+                self.purgatory_countdown = rules.purgatory_length
+            elif self.fails_in_a_row == rules.fails_before_purgatory:
+                self.purgatory_countdown = rules.purgatory_length
+        else:
+            self.fails_in_a_row = 0
+        if review.result == ReviewResult.EASY:
+            if self.purgatory_countdown:
+                self.purgatory_countdown -= 1
+        if self.purgatory_countdown:
+            self.prompt = {ReviewPrompAspect.REFERENCE,
+                           ReviewPrompAspect.FIRST_LETTERS}
+            self.frequency = rules.purgatory_frequency
+        else:
+            self.prompt = review.prompt
+
+        if self.frequency < rules.min_frequency:
+            self.frequency = rules.min_frequency
+        if review.result == ReviewResult.FAIL:
+            self.last_hard_or_failed = review
+            self.frequency -= rules.fail_step
+            if self.frequency > rules.decay_threshold:
+                self.frequency *= rules.fail_factor
+        elif review.result == ReviewResult.HARD:
+            self.last_hard_or_failed = review
+            self.frequency -= rules.hard_step
+            if self.frequency > rules.decay_threshold:
+                self.frequency *= rules.hard_factor
+        elif review.result == ReviewResult.EASY:
+            self.last_easy = review
+            if (self.previous_easy
+                    and review.timestamp - self.previous_easy.timestamp
+                    < rules.easy_repeat_window):
+                self.previous_easy = review
+                return
+            self.previous_easy = review
+            if ReviewPrompAspect.BLIND in review.prompt:
+                self.frequency += rules.blind_step
+                if (previous_review
+                        and previous_review.result == ReviewResult.EASY):
+                    d = abs(review.timestamp - previous_review.timestamp) \
+                        * rules.blind_growth
+                    if d > self.frequency:
+                        self.frequency = d
+            elif ReviewPrompAspect.FIRST_WORD in review.prompt:
+                self.frequency += rules.first_word_step
+            elif ReviewPrompAspect.FIRST_LETTERS in review.prompt:
+                self.frequency = rules.hinted_frequency
+            elif ReviewPrompAspect.ENDING_UNDERSCORE in review.prompt:
+                self.frequency = rules.hinted_frequency
+
+    def finalize(self, now=None):
+        if now is None:
+            now = int(time.time())
+        self.now = now
+        self.due = now - 1
+        bucket_2, bucket_3, bucket_4 = self.rules.bucket_thresholds
+        self.review_bucket = 5
+        if self.frequency < bucket_2:
+            self.review_bucket = 2
+        elif self.frequency < bucket_3:
+            self.review_bucket = 3
+        elif self.frequency < bucket_4:
+            self.review_bucket = 4
+        if self.last_easy:
+            self.due_date = self.last_easy.timestamp + self.frequency
+        else:
+            self.score = 1
+            self.review_bucket = 1
+            self.due_date = now - 1
+            return
+        if self.last_hard_or_failed:
+            min_due_date = self.last_hard_or_failed.timestamp \
+                + self.rules.retry_delay
+            if min_due_date > self.due_date:
+                self.due_date = min_due_date
+            if (self.last_easy
+                    and self.last_easy.timestamp
+                    < self.last_hard_or_failed.timestamp):
+                self.review_bucket = 1
+        if self.last_easy:
+            self.ratio = (now - self.last_easy.timestamp) / \
+                (self.due_date - self.last_easy.timestamp)
+        else:
+            self.review_bucket = 0
+            self.ratio = 0
+        if now > self.due_date:
+            self.score = 10 + int((now - self.due_date) // DAY)
+        else:
+            self.score = 0
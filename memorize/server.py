@@ -0,0 +1,358 @@
+"""Serve reviews to several learners from one process.
+
+    python -m memorize.server --port 8765
+
+Requests and responses are JSON objects, one per line:
+
+    {"id": 1, "user": "ann", "method": "candidates", "params": {"count": 5}}
+    {"id": 1, "result": [{"reference": "John 3:16", "prompt": [...]}, ...]}
+
+Each user's reviews are kept in users/<user>/reviews.db. The verses, their
+tokens and the prompt renderings come from the one verses.yaml in the
+working directory and are shared by every user. A review can give the
+learner's `utc_offset` in seconds, the server's own is assumed otherwise.
+
+Grading and the work on a user's database run in a pool of threads so
+that the event loop keeps answering other users. A user's own requests take
+turns.
+"""
+import asyncio
+import click
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import heapq
+import json
+import logging
+import os
+import pendulum
+import re
+import time
+
+from . diff import fuzzydiff
+from . model import (Reference, Review, ReviewPrompAspect,
+                     ReviewResponseAspect, ReviewResult, Transcript,
+                     deprecated_text_prompts, step_down_difficulty,
+                     step_up_difficulty)
+from . prompt import render_prompt
+from . reviews import (MODELS, ReviewModel, ScheduleModel, ReferenceModel,
+                       catalog, verses, open_database, setup_database,
+                       flag_edited_verses,
+                       iter_reviews_by_reference, reviews_for_reference,
+                       save_review_sqlite, save_schedule, save_transcript,
+                       update_schedule)
+from . schedule import ReviewScore, DEFAULT_RULES
+
+USERS = "users"
+# Users with an open database, the least recently used is closed first.
+MAX_OPEN_USERS = 64
+
+_user_name = re.compile(r"[A-Za-z0-9_-]{1,64}")
+_read_aloud = frozenset({ReviewResponseAspect.READ_ALOUD})
+
+
+class RequestError(Exception):
+    pass
+
+
+def _first_prompt(score):
+    # Mirrors do_increasing_difficulty_review, there is no image viewer.
+    if score.prompt:
+        prompt = set(score.prompt)
+        prompt.add(ReviewPrompAspect.REFERENCE)
+    else:
+        prompt = {ReviewPrompAspect.REFERENCE, ReviewPrompAspect.FULL_TEXT}
+    if prompt.intersection(deprecated_text_prompts):
+        prompt = step_down_difficulty(prompt)
+    prompt.discard(ReviewPrompAspect.IMAGE)
+    return prompt
+
+
+def _parse_prompt(values):
+    try:
+        return frozenset(ReviewPrompAspect(v) for v in values)
+    except ValueError as e:
+        raise RequestError(str(e))
+
+
+def _encode_prompt(prompt):
+    return sorted(a.value for a in prompt)
+
+
+def _parse_reference(text):
+    try:
+        reference = Reference.parse(text)
+    except AttributeError:
+        reference = None
+    if reference not in verses:
+        raise RequestError(f"unknown reference {text}")
+    return reference
+
+
+def _candidate_key(candidate):
+    # The order of (bucket, reference), attrs' comparisons are much slower
+    bucket, r = candidate
+    return bucket, r.book, r.chapter, r.verse, r.verse_end
+
+
+class UserStore:
+    """One learner's reviews.db and schedule.
+
+    The models are bound to the terminal app's database, so every operation
+    rebinds them with bind_ctx, which only affects the calling thread. The
+    store isn't safe to use from two threads at once, `lock` is held by the
+    request using it.
+    """
+
+    def __init__(self, name, directory=USERS):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self.lock = asyncio.Lock()
+        self.database = None
+        self.schedule = None
+
+    def open(self):
+        os.makedirs(self.path, exist_ok=True)
+        self.database = open_database(os.path.join(self.path, "reviews.db"),
+                                      max_connections=1)
+        with self.bound():
+            setup_database(self.database)
+            flag_edited_verses(catalog.hashes)
+            if (not ScheduleModel.select().exists()
+                    and ReviewModel.select().exists()):
+                # Written before the schedule was persisted
+                save_schedule([ReviewScore(reference, reviews)
+                               for reference, reviews
+                               in iter_reviews_by_reference()])
+            query = (ScheduleModel
+                     .select(ReferenceModel.book, ReferenceModel.chapter,
+                             ReferenceModel.verse, ReferenceModel.verse_end,
+                             ScheduleModel.due, ScheduleModel.bucket)
+                     .join(ReferenceModel)
+                     .tuples())
+            # {reference: (due, bucket)}
+            self.schedule = {Reference(*row[:4]): (row[4], row[5])
+                             for row in self.database.execute(query)}
+
+    @contextlib.contextmanager
+    def bound(self):
+        """Bind the models to this database in the calling thread.
+
+        The connection goes back to the pool afterwards, the next operation
+        may run in another thread.
+        """
+        with self.database.connection_context(), \
+                self.database.bind_ctx(MODELS):
+            yield
+
+    def close(self):
+        if self.database is not None:
+            self.database.close_all()
+            self.database = None
+
+    def candidates(self, count=20, now=None):
+        """The same verses review_candidates would pick first."""
+        now = int(time.time()) if now is None else now
+        due = [(bucket, reference)
+               for reference, (due, bucket) in self.schedule.items()
+               if due < now and reference in verses]
+        # Never reviewed, bucket 1 like in ReviewScore.finalize
+        new = [(1, reference) for reference in verses
+               if reference not in self.schedule]
+        chosen = heapq.nsmallest(count, due + new, key=_candidate_key)
+        results = []
+        with self.bound():
+            for bucket, reference in chosen:
+                score = ReviewScore(reference,
+                                    list(reviews_for_reference(reference)),
+                                    now)
+                results.append({
+                    "reference": str(reference),
+                    "prompt": _encode_prompt(_first_prompt(score)),
+                    "bucket": bucket,
+                    "purgatory": bool(score.purgatory_countdown),
+                })
+        return results
+
+    def review(self, reference, prompt, result, text=None, score=None,
+               now=None, utc_offset=None):
+        """Save a review, and the transcript it was graded from if given.
+
+        Returns the prompt to try next if the verse was easy, None when
+        this verse is done for the session.
+        """
+        now = int(time.time()) if now is None else now
+        if utc_offset is None:
+            utc_offset = pendulum.from_timestamp(
+                now, tz=pendulum.local_timezone()).offset
+        r = Review(reference, now, prompt, _read_aloud, result, utc_offset)
+        with self.bound():
+            save_review_sqlite(r)
+            new_score, = update_schedule([reference])
+            if text is not None:
+                save_transcript(Transcript(reference, now, verses[reference],
+                                           text, score, result), r)
+        self.schedule[reference] = (int(new_score.due_date),
+                                    new_score.review_bucket)
+        if result != ReviewResult.EASY or new_score.purgatory_countdown:
+            return None
+        next_prompt = step_up_difficulty(prompt)
+        if next_prompt == set(prompt):
+            return None
+        return next_prompt
+
+
+def _grade(reference, text):
+    diff = fuzzydiff(verses[reference], text, catalog.tokens(reference))
+    score = diff.score()
+    return {
+        "chunks": [[chunk_type.value, token.original]
+                   for chunk_type, token in diff.chunks],
+        "score": score,
+        "result": DEFAULT_RULES.grade(score).value,
+    }
+
+
+class Server:
+
+    def __init__(self, directory=USERS, max_open_users=MAX_OPEN_USERS):
+        self.directory = directory
+        self.max_open_users = max_open_users
+        self.users = collections.OrderedDict()
+        self.executor = concurrent.futures.ThreadPoolExecutor()
+
+    async def run(self, f, *args, **kwargs):
+        """Run f in the thread pool."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(f, *args, **kwargs))
+
+    @contextlib.asynccontextmanager
+    async def user(self, name):
+        """Hold the user's open store until the block ends."""
+        if not isinstance(name, str) or not _user_name.fullmatch(name):
+            raise RequestError(f"bad user name {name!r}")
+        while True:
+            store = self.users.get(name)
+            if store is None:
+                store = self.users[name] = UserStore(name, self.directory)
+                if len(self.users) > self.max_open_users:
+                    _, oldest = self.users.popitem(last=False)
+                    async with oldest.lock:
+                        await self.run(oldest.close)
+            else:
+                self.users.move_to_end(name)
+            async with store.lock:
+                if self.users.get(name) is not store:
+                    # Closed while this request waited for it
+                    continue
+                if store.database is None:
+                    await self.run(store.open)
+                yield store
+                return
+
+    async def candidates(self, user, count=20):
+        count = int(count)
+        async with self.user(user) as store:
+            return await self.run(store.candidates, count)
+
+    async def prompt(self, user, reference, prompt):
+        # Cheaper than handing it to a thread
+        return {"text": render_prompt(_parse_reference(reference),
+                                      _parse_prompt(prompt))}
+
+    async def grade(self, user, reference, text):
+        """Grade a transcript of a recitation without saving anything."""
+        return await self.run(_grade, _parse_reference(reference), text)
+
+    async def review(self, user, reference, prompt, result, text=None,
+                     score=None, utc_offset=None):
+        try:
+            result = ReviewResult(result)
+        except ValueError as e:
+            raise RequestError(str(e))
+        if utc_offset is not None and (
+                not isinstance(utc_offset, int)
+                or abs(utc_offset) > 14 * 60 * 60):
+            raise RequestError(f"bad utc_offset {utc_offset!r}")
+        reference = _parse_reference(reference)
+        prompt = _parse_prompt(prompt)
+        if text is not None and score is None:
+            score = (await self.run(_grade, reference, text))["score"]
+        async with self.user(user) as store:
+            next_prompt = await self.run(store.review, reference, prompt,
+                                         result, text, score,
+                                         utc_offset=utc_offset)
+        return {"next_prompt": (_encode_prompt(next_prompt)
+                                if next_prompt else None)}
+
+    methods = {"candidates", "prompt", "grade", "review"}
+
+    async def handle(self, request):
+        if not isinstance(request, dict):
+            return {"id": None, "error": "request must be an object"}
+        response = {"id": request.get("id")}
+        method = request.get("method")
+        if method not in self.methods:
+            response["error"] = f"unknown method {method!r}"
+            return response
+        try:
+            response["result"] = await getattr(self, method)(
+                request.get("user"), **request.get("params", {}))
+        except (RequestError, TypeError) as e:
+            response["error"] = str(e)
+        except Exception:
+            logging.exception(f"{method} for {request.get('user')}")
+            response["error"] = "internal error"
+        return response
+
+    async def serve_client(self, reader, writer):
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    response = {"id": None, "error": "malformed request"}
+                else:
+                    response = await self.handle(request)
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except ConnectionResetError:
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        self.executor.shutdown()
+        for store in self.users.values():
+            store.close()
+        self.users.clear()
+
+
+async def serve(host, port, directory=USERS):
+    server = Server(directory)
+    listener = await asyncio.start_server(server.serve_client, host, port)
+    print(f"serving on {host}:{port}", flush=True)
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.close()
+
+
+@click.command()
+@click.option("--host", default="127.0.0.1", show_default=True)
+@click.option("--port", default=8765, show_default=True)
+@click.option("--users", "directory", default=USERS, show_default=True,
+              help="directory with a reviews.db per user")
+def main(host, port, directory):
+    logging.basicConfig(filename="server.log", encoding="utf-8",
+                        level=logging.WARNING)
+    try:
+        asyncio.run(serve(host, port, directory))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
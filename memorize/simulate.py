@@ -0,0 +1,250 @@
+"""Replay synthetic learners against the real scheduler.
+
+    python -m memorize.simulate --years 3 \\
+        --grid fail_factor=0.2,0.3,0.5 --grid blind_growth=1.2,1.32,1.5
+"""
+import attr
+import click
+import concurrent.futures
+import heapq
+import itertools
+import json
+import math
+import random
+import time
+
+from . model import (Reference, Review, ReviewPrompAspect,
+                     ReviewResponseAspect, ReviewResult, text_prompt_levels,
+                     step_up_difficulty)
+from . schedule import ReviewScore, SpacingRules, DEFAULT_RULES, DAY, HOUR
+
+_read_aloud = frozenset({ReviewResponseAspect.READ_ALOUD})
+_first_prompt = frozenset({ReviewPrompAspect.REFERENCE,
+                           ReviewPrompAspect.FULL_TEXT})
+
+
+@attr.frozen
+class Learner:
+    """A simple forgetting curve model of someone using the app.
+
+    The chance of reciting a verse blind decays as exp(-days / stability).
+    Text prompts make up for part of what was forgotten, a full text prompt
+    all of it.
+    """
+    verses: int = 200
+    # Candidates reviewed per session, the `--count` of `review`.
+    count: int = 20
+    sessions_per_day: int = 1
+    initial_stability: float = 1.
+    # Stability multiplier after recalling a verse that was hard to recall.
+    growth: float = 3.
+    lapse: float = .5
+    # Mean fraction of words missed when the verse was recalled.
+    slip: float = .015
+
+
+@attr.frozen
+class SimulationResult:
+    rules: SpacingRules
+    learner: Learner
+    seed: int
+    days: int
+    reviews: int
+    easy: int
+    # Mean chance of reciting blind at the time of each review.
+    retention: float
+    # Due verses that didn't fit in a session, sampled once a day.
+    backlog: list[int]
+
+    def summary(self):
+        return {
+            "reviews_per_day": self.reviews / self.days,
+            "easy_rate": self.easy / self.reviews if self.reviews else 0,
+            "retention": self.retention,
+            "final_backlog": self.backlog[-1] if self.backlog else 0,
+            "max_backlog": max(self.backlog, default=0),
+        }
+
+
+def _hint(prompt):
+    """How much of the verse the prompt gives away, from 0 to 1."""
+    last = len(text_prompt_levels) - 1
+    for i, level in enumerate(text_prompt_levels):
+        if level in prompt:
+            return 1 - i / last
+    return 1.
+
+
+def simulate(rules=DEFAULT_RULES, learner=Learner(), days=365, seed=0):
+    rnd = random.Random(seed)
+    references = [Reference("Sim", 1 + i // 100, 1 + i % 100, 1 + i % 100)
+                  for i in range(learner.verses)]
+    scores = [None] * learner.verses
+    stability = [learner.initial_stability] * learner.verses
+    last_seen = [0] * learner.verses
+    # Verses that have never been reviewed come first, like in
+    # review_candidates where they have review bucket 1.
+    unseen = list(range(learner.verses))
+    unseen.reverse()
+    due = []
+    prompts = {}
+    reviews = 0
+    easy = 0
+    retention = 0.
+    backlog = []
+    start = 0
+    session_gap = DAY // learner.sessions_per_day
+
+    def review(i, now, prompt):
+        nonlocal reviews, easy, retention
+        elapsed = (now - last_seen[i]) / DAY if last_seen[i] else 0.
+        blind = math.exp(-elapsed / stability[i]) if last_seen[i] else 0.
+        hint = _hint(prompt)
+        p = 1 - (1 - blind) * (1 - hint)
+        if rnd.random() < p:
+            score = 1 - rnd.expovariate(1 / learner.slip)
+            stability[i] *= 1 + learner.growth * (1 - blind) * (1 - hint)
+        else:
+            score = rnd.uniform(.5, rules.hard_cutoff)
+            stability[i] = max(learner.initial_stability,
+                               stability[i] * learner.lapse)
+        last_seen[i] = now
+        result = rules.grade(score)
+        reviews += 1
+        retention += blind
+        if result == ReviewResult.EASY:
+            easy += 1
+        return Review(references[i], now, prompt, _read_aloud, result)
+
+    for session in range(days * learner.sessions_per_day):
+        now = start + session * session_gap + 9 * HOUR
+        candidates = []
+        while due and due[0][0] < now:
+            _, i = heapq.heappop(due)
+            candidates.append((scores[i].review_bucket, i))
+        candidates.sort()
+        todo = [i for _, i in candidates[:learner.count]]
+        while len(todo) < learner.count and unseen:
+            todo.append(unseen.pop())
+        for _, i in candidates[learner.count:]:
+            heapq.heappush(due, (scores[i].due_date, i))
+        if session % learner.sessions_per_day == 0:
+            backlog.append(max(0, len(candidates) - learner.count))
+
+        for i in todo:
+            score = scores[i]
+            prompt = (frozenset(score.prompt) if score and score.prompt
+                      else _first_prompt)
+            prompt = prompt | {ReviewPrompAspect.REFERENCE}
+            new = []
+            t = now
+            # Mirrors do_increasing_difficulty_review
+            for _ in range(2):
+                r = review(i, t, prompt)
+                new.append(r)
+                t += 60
+                if r.result != ReviewResult.EASY:
+                    break
+                if score and score.purgatory_countdown:
+                    break
+                new_prompt = prompts.get(prompt)
+                if new_prompt is None:
+                    new_prompt = frozenset(step_up_difficulty(prompt))
+                    prompts[prompt] = new_prompt
+                if new_prompt == prompt:
+                    break
+                prompt = new_prompt
+            if score is None:
+                score = scores[i] = ReviewScore(references[i], new, t,
+                                                rules=rules)
+            else:
+                score.extend(new)
+                score.finalize(t)
+            heapq.heappush(due, (score.due_date, i))
+
+    return SimulationResult(rules=rules, learner=learner, seed=seed,
+                            days=days, reviews=reviews, easy=easy,
+                            retention=retention / reviews if reviews else 0.,
+                            backlog=backlog)
+
+
+def _run(args):
+    return simulate(*args)
+
+
+def sweep(grid, learner=Learner(), days=365, seeds=1, workers=None):
+    """Simulate every combination of the SpacingRules values in grid."""
+    names = list(grid)
+    jobs = []
+    for values in itertools.product(*(grid[n] for n in names)):
+        rules = attr.evolve(DEFAULT_RULES, **dict(zip(names, values)))
+        for seed in range(seeds):
+            jobs.append((rules, learner, days, seed))
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        return list(pool.map(_run, jobs, chunksize=1))
+
+
+def _parse_grid(options):
+    grid = {}
+    fields = {f.name: f for f in attr.fields(SpacingRules)}
+    for option in options:
+        name, _, values = option.partition("=")
+        if name not in fields:
+            raise click.BadParameter(f"unknown spacing rule {name}")
+        # The annotation, the defaults of float durations are ints.
+        convert = fields[name].type
+        if convert not in (int, float):
+            raise click.BadParameter(f"{name} can't be swept")
+        try:
+            grid[name] = [convert(v) for v in values.split(",")]
+        except ValueError as e:
+            raise click.BadParameter(f"{name}: {e}")
+    return grid
+
+
+@click.command()
+@click.option("--grid", multiple=True,
+              help="rule=value,value,... for any SpacingRules field")
+@click.option("--years", default=2.)
+@click.option("--verses", default=attr.fields(Learner).verses.default)
+@click.option("--count", default=attr.fields(Learner).count.default)
+@click.option("--seeds", default=2)
+@click.option("--workers", type=int)
+@click.option("--json", "as_json", is_flag=True)
+def main(grid, years, verses, count, seeds, workers, as_json):
+    learner = Learner(verses=verses, count=count)
+    days = int(years * 365)
+    grid = _parse_grid(grid)
+    start = time.perf_counter()
+    results = sweep(grid, learner, days, seeds, workers)
+    elapsed = time.perf_counter() - start
+
+    rows = []
+    for rules, group in itertools.groupby(results, key=lambda r: r.rules):
+        group = list(group)
+        summaries = [r.summary() for r in group]
+        row = {name: getattr(rules, name) for name in grid}
+        for key in summaries[0]:
+            row[key] = sum(s[key] for s in summaries) / len(summaries)
+        # Backlog at the end of each month, averaged over the seeds
+        row["backlog_by_month"] = [
+            sum(r.backlog[d] for r in group) / len(group)
+            for d in range(29, days, 30)]
+        rows.append(row)
+
+    total = sum(r.reviews for r in results)
+    if as_json:
+        print(json.dumps(rows, indent=2))
+    else:
+        for row in rows:
+            print(", ".join(f"{k}={v:.3g}" if isinstance(v, float)
+                            else f"{k}={v}" for k, v in row.items()
+                            if k != "backlog_by_month"))
+            print("  backlog by month:",
+                  " ".join(f"{b:.0f}" for b in row["backlog_by_month"]))
+    print(f"{total} simulated reviews in {elapsed:.1f}s "
+          f"({total / elapsed * 60:,.0f} per minute)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""Speech recognition, optionally shared between processes.
+
+Loading the Vosk model takes seconds and hundreds of MB, so a long running
+
+    python -m memorize.speech serve
+
+can load it once and decode for every other process over a Unix socket.
+open_stream uses the service when it is running and decodes in-process
+otherwise.
+
+Both directions of a connection are length prefixed frames. The client
+sends a JSON header with the samplerate and number of alternatives, then
+int16 mono audio; the server answers each audio frame with Vosk's partial
+or final result as JSON. An empty frame ends the stream and is answered
+with the final result.
+"""
+import click
+import collections
+import functools
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import tempfile
+import threading
+import wave
+
+import vosk
+
+SOCKET = os.environ.get(
+    "MEMORIZE_SPEECH_SOCKET",
+    os.path.join(tempfile.gettempdir(), f"memorize-speech-{os.getuid()}.sock"))
+MODEL = "model"
+
+_length = struct.Struct("<I")
+
+
+@functools.cache
+def load_model(path=MODEL):
+    logging.info(f"loading speech model {path}")
+    return vosk.Model(path)
+
+
+def _send(f, payload):
+    f.write(_length.pack(len(payload)) + payload)
+    f.flush()
+
+
+def _receive(f):
+    header = f.read(_length.size)
+    if len(header) < _length.size:
+        raise EOFError
+    length, = _length.unpack(header)
+    payload = f.read(length)
+    if len(payload) < length:
+        raise EOFError
+    return payload
+
+
+class LocalStream:
+    """Decode in this process."""
+
+    def __init__(self, samplerate, alternatives=5, recognizer=None):
+        if recognizer is None:
+            recognizer = vosk.KaldiRecognizer(load_model(), samplerate)
+            recognizer.SetMaxAlternatives(alternatives)
+        self.recognizer = recognizer
+
+    def accept(self, data):
+        """Return Vosk's result if data completed an utterance, else the
+        partial result."""
+        if self.recognizer.AcceptWaveform(data):
+            return json.loads(self.recognizer.Result())
+        return json.loads(self.recognizer.PartialResult())
+
+    def finish(self):
+        return json.loads(self.recognizer.FinalResult())
+
+    def close(self):
+        pass
+
+
+class RemoteStream:
+    """Decode in the speech service."""
+
+    def __init__(self, samplerate, alternatives=5, path=SOCKET):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.socket.connect(path)
+        except OSError:
+            self.socket.close()
+            raise
+        self.file = self.socket.makefile("rwb")
+        _send(self.file, json.dumps({"samplerate": samplerate,
+                                     "alternatives": alternatives}).encode())
+
+    def accept(self, data):
+        if not data:
+            return {"partial": ""}
+        _send(self.file, data)
+        return json.loads(_receive(self.file))
+
+    def finish(self):
+        _send(self.file, b"")
+        return json.loads(_receive(self.file))
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+def open_stream(samplerate, alternatives=5, path=SOCKET):
+    try:
+        return RemoteStream(samplerate, alternatives, path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        return LocalStream(samplerate, alternatives)
+
+
+def recognize_wav(path, alternatives=5, chunk_frames=4000):
+    """Return the final results of every utterance in a mono int16 WAV."""
+    with wave.open(path, "rb") as f:
+        if f.getnchannels() != 1 or f.getsampwidth() != 2:
+            raise ValueError(f"{path}: expected mono 16 bit audio")
+        stream = open_stream(f.getframerate(), alternatives)
+        try:
+            results = []
+            while data := f.readframes(chunk_frames):
+                res = stream.accept(data)
+                if "partial" not in res:
+                    results.append(res)
+            results.append(stream.finish())
+        finally:
+            stream.close()
+    return results
+
+
+class RecognizerPool:
+    """Idle recognizers by samplerate and number of alternatives.
+
+    Creating a KaldiRecognizer builds its decoding graph state, so they are
+    reset and reused instead.
+    """
+
+    def __init__(self, model, size=4):
+        self.model = model
+        self.size = size
+        self.lock = threading.Lock()
+        self.idle = collections.defaultdict(list)
+
+    def acquire(self, samplerate, alternatives):
+        with self.lock:
+            idle = self.idle[(samplerate, alternatives)]
+            if idle:
+                return idle.pop()
+        recognizer = vosk.KaldiRecognizer(self.model, samplerate)
+        recognizer.SetMaxAlternatives(alternatives)
+        return recognizer
+
+    def release(self, samplerate, alternatives, recognizer):
+        recognizer.Reset()
+        with self.lock:
+            idle = self.idle[(samplerate, alternatives)]
+            if len(idle) < self.size:
+                idle.append(recognizer)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        pool = self.server.pool
+        try:
+            header = json.loads(_receive(self.rfile))
+        except (EOFError, ValueError):
+            return
+        samplerate = int(header["samplerate"])
+        alternatives = int(header.get("alternatives", 5))
+        recognizer = pool.acquire(samplerate, alternatives)
+        try:
+            while True:
+                data = _receive(self.rfile)
+                if not data:
+                    _send(self.wfile, recognizer.FinalResult().encode())
+                    return
+                if recognizer.AcceptWaveform(data):
+                    res = recognizer.Result()
+                else:
+                    res = recognizer.PartialResult()
+                _send(self.wfile, res.encode())
+        except (EOFError, BrokenPipeError, ConnectionResetError):
+            logging.info("client went away mid stream")
+        finally:
+            pool.release(samplerate, alternatives, recognizer)
+
+
+class SpeechServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, pool):
+        self.pool = pool
+        super().__init__(path, _Handler)
+        os.chmod(path, 0o600)
+
+
+def _remove_stale_socket(path):
+    if not os.path.exists(path):
+        return
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except ConnectionRefusedError:
+        os.remove(path)
+    else:
+        raise click.ClickException(f"already serving on {path}")
+    finally:
+        s.close()
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command()
+@click.option("--socket", "path", default=SOCKET, show_default=True)
+@click.option("--model", "model_path", default=MODEL, show_default=True)
+@click.option("--pool-size", default=4, show_default=True,
+              help="idle recognizers kept per samplerate")
+def serve(path, model_path, pool_size):
+    logging.basicConfig(level=logging.INFO)
+    _remove_stale_socket(path)
+    pool = RecognizerPool(load_model(model_path), pool_size)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    with SpeechServer(path, pool) as server:
+        print(f"serving on {path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(path)
+
+
+@main.command()
+@click.option("--alternatives", default=1)
+@click.argument("files", nargs=-1, type=click.Path(exists=True))
+def transcribe(alternatives, files):
+    for path in files:
+        results = recognize_wav(path, alternatives)
+        texts = [r["alternatives"][0]["text"] if "alternatives" in r
+                 else r.get("text", "") for r in results]
+        print(f"{path}: {' '.join(t for t in texts if t)}")
+
+
+if __name__ == "__main__":
+    main()
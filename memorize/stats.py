@@ -0,0 +1,134 @@
+"""Aggregates over reviews.db computed by SQLite.
+
+Every query runs on the read-only connection and returns small rows, so
+none of them needs the reviews loaded into Python.
+"""
+import collections
+import datetime
+import time
+
+import peewee
+from peewee import fn
+
+from . model import (Reference, ReviewPrompAspect, ReviewResult,
+                     text_prompt_levels)
+from . reviews import ReferenceModel, ReviewModel, ScheduleModel, connection
+from . schedule import DAY
+
+_fail = ReviewResult.FAIL.value
+_hard = ReviewResult.HARD.value
+
+
+def _day(timestamp):
+    return datetime.date(1970, 1, 1) + datetime.timedelta(
+        days=timestamp // DAY)
+
+
+def _count_results():
+    return (fn.COUNT(ReviewModel.id).alias("reviews"),
+            fn.SUM(ReviewModel.result == _fail).alias("fails"),
+            fn.SUM(ReviewModel.result == _hard).alias("hards"))
+
+
+def reviews_per_day(days=30, now=None):
+    """[(date, reviews, fails)] in the local time of each review."""
+    now = int(time.time()) if now is None else now
+    local_day = (ReviewModel.timestamp + ReviewModel.utc_offset) / DAY
+    query = (ReviewModel
+             .select(local_day.alias("day"), *_count_results()[:2])
+             .where(ReviewModel.timestamp >= now - days * DAY)
+             .group_by(peewee.SQL("day"))
+             .order_by(peewee.SQL("day"))
+             .tuples())
+    with connection(read_only=True) as database:
+        return [(_day(day * DAY), reviews, fails)
+                for day, reviews, fails in database.execute(query)]
+
+
+def fail_rate_by_book():
+    """[(book, reviews, fail rate)], worst first."""
+    # Counting per reference first lets SQLite use the covering index.
+    per_reference = (ReviewModel
+                     .select(ReviewModel.reference, *_count_results()[:2])
+                     .group_by(ReviewModel.reference))
+    query = (ReferenceModel
+             .select(ReferenceModel.book,
+                     fn.SUM(per_reference.c.reviews),
+                     fn.SUM(per_reference.c.fails))
+             .join(per_reference,
+                   on=(per_reference.c.reference_id == ReferenceModel.id))
+             .group_by(ReferenceModel.book)
+             .tuples())
+    with connection(read_only=True) as database:
+        rows = [(book, reviews, fails / reviews)
+                for book, reviews, fails in database.execute(query)]
+    rows.sort(key=lambda row: -row[2])
+    return rows
+
+
+def _prompt_level(prompt):
+    aspects = {ReviewPrompAspect(s) for s in prompt.split(",")}
+    for level in text_prompt_levels:
+        if level in aspects:
+            return level.value
+    return "none"
+
+
+def fail_rate_by_prompt_level():
+    """[(text prompt level, reviews, fail rate)] from easiest to hardest.
+
+    Prompts are stored as sets, so SQLite groups by the few distinct prompts
+    and they are folded into levels here.
+    """
+    query = (ReviewModel
+             .select(ReviewModel.prompt, *_count_results()[:2])
+             .group_by(ReviewModel.prompt)
+             .tuples())
+    counts = collections.defaultdict(lambda: [0, 0])
+    with connection(read_only=True) as database:
+        for prompt, reviews, fails in database.execute(query):
+            level = counts[_prompt_level(prompt)]
+            level[0] += reviews
+            level[1] += fails
+    order = [level.value for level in text_prompt_levels] + ["none"]
+    return [(level, counts[level][0], counts[level][1] / counts[level][0])
+            for level in order if level in counts]
+
+
+def due_forecast(days=14, now=None):
+    """[(date, verses due)] for the next days, overdue verses count today."""
+    now = int(time.time()) if now is None else now
+    today = now // DAY
+    due_day = fn.MAX(ScheduleModel.due / DAY, today)
+    query = (ScheduleModel
+             .select(due_day.alias("day"), fn.COUNT(ScheduleModel.id))
+             .where(ScheduleModel.due < (today + days) * DAY)
+             .group_by(peewee.SQL("day"))
+             .order_by(peewee.SQL("day"))
+             .tuples())
+    with connection(read_only=True) as database:
+        due = dict(database.execute(query))
+    return [(_day(day * DAY), due.get(day, 0))
+            for day in range(today, today + days)]
+
+
+def slowest_to_learn(limit=10):
+    """[(reference, reviews, fails, hards, frequency)] for the verses that
+    took the most failed and hard reviews."""
+    slowest = (ReviewModel
+               .select(ReviewModel.reference, *_count_results())
+               .group_by(ReviewModel.reference)
+               .order_by(peewee.SQL("fails + hards").desc())
+               .limit(limit))
+    query = (ReferenceModel
+             .select(ReferenceModel.book, ReferenceModel.chapter,
+                     ReferenceModel.verse, ReferenceModel.verse_end,
+                     slowest.c.reviews, slowest.c.fails, slowest.c.hards,
+                     ScheduleModel.frequency)
+             .join(slowest, on=(slowest.c.reference_id == ReferenceModel.id))
+             .join_from(ReferenceModel, ScheduleModel, peewee.JOIN.LEFT_OUTER)
+             .order_by((slowest.c.fails + slowest.c.hards).desc())
+             .tuples())
+    with connection(read_only=True) as database:
+        return [(Reference(*row[:4]), *row[4:])
+                for row in database.execute(query)]
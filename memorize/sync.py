@@ -0,0 +1,167 @@
+import os.path
+
+from . reviews import (MODELS, DeviceModel, open_database,
+                       setup_database, local_device_id,
+                       save_review_sqlite, reviews_after, last_review_id,
+                       update_schedule)
+from . reviewlog import ReviewLog
+
+
+class DatabasePeer:
+    """Another reviews.db, opened by temporarily rebinding the models."""
+
+    def __init__(self, path):
+        self.database = open_database(path, max_connections=1)
+        with self.bound():
+            setup_database(self.database)
+            self.device_id = local_device_id()
+
+    def bound(self):
+        return self.database.bind_ctx(MODELS)
+
+    def read(self, after):
+        """Return the reviews stored after `after` and the new position.
+
+        Both are read in one transaction, so the position is that of the
+        last review returned.
+        """
+        with self.bound(), self.database.atomic("DEFERRED"):
+            return list(reviews_after(after)), last_review_id()
+
+    def write(self, reviews, device_id, pulled, read_position):
+        """Store reviews and remember how far the two databases are merged.
+
+        The peer's view is the mirror image of ours: what we pulled from it
+        is what it pushed to us and the other way around. Returns the
+        position to pull from next time, past the reviews just written
+        unless another process stored reviews since they were read.
+
+        >>> import tempfile
+        >>> from memorize.model import (Reference, Review, ReviewPrompAspect,
+        ...                             ReviewResponseAspect, ReviewResult)
+        >>> def review(timestamp):
+        ...     return Review(Reference.parse("John 11:35"), timestamp,
+        ...                   frozenset({ReviewPrompAspect.BLIND}),
+        ...                   frozenset({ReviewResponseAspect.READ_ALOUD}),
+        ...                   ReviewResult.EASY)
+        >>> peer = DatabasePeer(os.path.join(tempfile.mkdtemp(), "b.db"))
+        >>> reviews, position = peer.read(0)
+
+        Another process stores a review before ours are written, so the
+        position stays where it was read.
+
+        >>> with peer.bound():
+        ...     save_review_sqlite(review(1))
+        True
+        >>> peer.write([review(2)], "a", 0, position) == position
+        True
+        """
+        with self.bound(), self.database.atomic("IMMEDIATE"):
+            unread = last_review_id() != read_position
+            new = [r for r in reviews if save_review_sqlite(r)]
+            position = read_position if unread else last_review_id()
+            device, _ = DeviceModel.get_or_create(device_id=device_id)
+            device.pulled = pulled
+            device.pushed = position
+            device.save()
+            update_schedule({r.reference for r in new})
+        return position
+
+    def close(self):
+        self.database.close()
+
+
+class LogPeer:
+    """A reviews.log, positions are byte offsets into it."""
+
+    def __init__(self, path):
+        self.log = ReviewLog(path)
+        self.device_id = "log:" + os.path.abspath(path)
+
+    def read(self, after):
+        reviews = []
+        for after, r in self.log.read(after):
+            reviews.append(r)
+        return reviews, after
+
+    def write(self, reviews, device_id, pulled, read_position):
+        if self.log.scores is None:
+            self.log.recover()
+        unread = self.log.end != read_position
+        self.log.extend(reviews)
+        self.log.snapshot()
+        return read_position if unread else self.log.end
+
+    def close(self):
+        pass
+
+
+def open_peer(path):
+    if path.endswith(".log"):
+        return LogPeer(path)
+    return DatabasePeer(path)
+
+
+def merge(path, review_log=None):
+    """Exchange reviews with another reviews.db or reviews.log.
+
+    Only the reviews added on either side since the previous merge are read.
+    Returns the number of reviews pulled and pushed and the references whose
+    local history changed.
+
+    >>> import tempfile
+    >>> from memorize.reviews import ScheduleModel
+    >>> from memorize.model import (Reference, Review, ReviewPrompAspect,
+    ...                             ReviewResponseAspect, ReviewResult)
+    >>> def review(timestamp):
+    ...     return Review(Reference.parse("John 11:35"), timestamp,
+    ...                   frozenset({ReviewPrompAspect.BLIND}),
+    ...                   frozenset({ReviewResponseAspect.READ_ALOUD}),
+    ...                   ReviewResult.EASY)
+    >>> directory = tempfile.mkdtemp()
+    >>> a, b = (os.path.join(directory, name) for name in ("a.db", "b.db"))
+    >>> with DatabasePeer(a).bound():
+    ...     save_review_sqlite(review(1))
+    ...     merge(b)
+    True
+    (0, 1, set())
+
+    Nothing is sent back, and the peer scheduled what it received.
+
+    >>> with DatabasePeer(b).bound():
+    ...     merge(a), ScheduleModel.select().count()
+    ((0, 0, set()), 1)
+    >>> with DatabasePeer(a).bound():
+    ...     merge(b)
+    (0, 0, set())
+    """
+    database = DeviceModel._meta.database
+    peer = open_peer(path)
+    try:
+        device, _ = DeviceModel.get_or_create(device_id=peer.device_id)
+
+        incoming, read_position = peer.read(device.pulled)
+        new = []
+        with database.atomic("IMMEDIATE"):
+            for r in incoming:
+                if save_review_sqlite(r):
+                    new.append(r)
+        if review_log:
+            review_log.extend(new)
+        incoming_uids = {r.uid for r in incoming}
+
+        # Reviews stored by another process after these are read wait for
+        # the next merge.
+        with database.atomic("DEFERRED"):
+            outgoing = [r for r in reviews_after(device.pushed)
+                        if r.uid not in incoming_uids]
+            local_position = last_review_id()
+        peer_position = peer.write(outgoing, local_device_id(),
+                                   local_position, read_position)
+
+        device.pulled = peer_position
+        device.pushed = local_position
+        device.save()
+    finally:
+        peer.close()
+    return len(new), len(outgoing), {r.reference for r in new}